@@ -0,0 +1,279 @@
+"""
+
+Benchmark of the state determination: query engines x workloads.
+
+Workloads (generated with a fixed seed, so every run uses the same geopositions):
+
+    uniform   - random geopositions, uniformly distributed over the bounding box of the lower 48 states
+    borders   - geopositions close to the state borders (random vertices of the polygons, slightly moved)
+    outside   - geopositions outside of all states (ocean, Canada, Mexico)
+    capitals  - the 50 US state capitals
+
+Query engines (see ENGINES):
+
+    scalar    - state_of_geoposition with the polygon test only (no grid index)
+    grid      - state_of_geoposition with the grid index (default configuration)
+    cache     - like grid, plus the result cache
+    batch     - state_of_geopositions (NumPy), one call per workload
+    sweep     - state_of_geopositions_sweep (NumPy, sort-and-sweep bulk join), one call per workload
+
+For each engine and workload the report contains the load time (constructor and index),
+the time of a first (warm-up) pass over the workload, latency percentiles per query of the
+following passes, throughput and peak memory (Python allocations during load
+and queries, measured in a separate run with tracemalloc; memory-mapped data is not included).
+The report is JSON, so that the results of two releases can be compared with diff.
+
+Usage:
+    python state_benchmark.py [--data states-US.bin] [--engines grid,scalar] [--workloads uniform,capitals]
+                              [--count 10000] [--repeat 1] [--seed 42] [--output report.json]
+
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import json
+import platform
+import random
+import sys
+
+from state_determination import CAPITALS, np, state_determination
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None      # Py 2: no memory measurement
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import time as clock
+
+
+
+#
+# Query engines: name -> (constructor keyword arguments, query mode)
+# Query mode 'single' calls state_of_geoposition per geoposition, 'batch' calls
+# state_of_geopositions and 'sweep' state_of_geopositions_sweep once for the whole workload.
+#
+ENGINES = {
+    'scalar': ({'grid_cell_size': None}, 'single'),
+    'grid': ({}, 'single'),
+    'cache': ({'cache_size': 100000}, 'single'),
+    'batch': ({'grid_cell_size': None}, 'batch'),
+    'sweep': ({'grid_cell_size': None}, 'sweep'),
+}
+
+WORKLOADS = ['uniform', 'borders', 'outside', 'capitals']
+
+# Bounding box of the lower 48 states (S, N, W, E)
+US_BBOX = (24.5, 49.4, -124.8, -66.9)
+
+
+
+
+#
+# The geopositions of a workload, always the same for the same seed (and data)
+#
+def make_workload(name, tester, count, seed):
+
+    rand = random.Random("{0}-{1}".format(name, seed))
+
+    if name == 'capitals':
+        return list(CAPITALS)
+
+    if name == 'uniform':
+        south, north, west, east = US_BBOX
+        return [(rand.uniform(south, north), rand.uniform(west, east)) for _ in range(count)]
+
+    if name == 'borders':
+        abbrevs = sorted(tester.states)
+        points = []
+        while len(points) < count:
+            state_data = tester.states[rand.choice(abbrevs)]
+            lats, longs = state_data['lats'], state_data['longs']
+            if len(lats) == 0:
+                continue
+            j = rand.randrange(len(lats))
+            points.append((lats[j] + rand.gauss(0, 0.01), longs[j] + rand.gauss(0, 0.01)))
+        return points
+
+    if name == 'outside':
+        # Around North America, only geopositions which are not in any state
+        points = []
+        while len(points) < count:
+            lat, long = rand.uniform(15.0, 60.0), rand.uniform(-130.0, -60.0)
+            if tester.state_of_geoposition(lat, long) is None:
+                points.append((lat, long))
+        return points
+
+    raise ValueError("Unknown workload {0}".format(name))
+
+
+
+
+#
+# Creates the engine, i.e. loads the data and builds the index.
+# The loading messages of state_determination go to stderr.
+#
+def load_engine(data_file, engine):
+
+    kwargs, mode = ENGINES[engine]
+    if mode in ('batch', 'sweep') and np is None:
+        raise ImportError("NumPy is required for the {0} engine".format(engine))
+
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        start = clock()
+        tester = state_determination(data_file, **kwargs)
+        loaded = clock()
+        tester.build_index()
+        indexed = clock()
+    finally:
+        sys.stdout = stdout
+
+    return tester, mode, loaded - start, indexed - loaded
+
+
+
+
+def _run_queries(tester, mode, points, repeat):
+
+    latencies = []
+    start = clock()
+
+    if mode in ('batch', 'sweep'):
+        lats = np.array([point[0] for point in points], dtype=np.float64)
+        longs = np.array([point[1] for point in points], dtype=np.float64)
+        query = tester.state_of_geopositions if mode == 'batch' else tester.state_of_geopositions_sweep
+        for _ in range(repeat):
+            before = clock()
+            query(lats, longs)
+            latencies.append((clock() - before) / max(len(points), 1))     # per geoposition
+    else:
+        query = tester.state_of_geoposition
+        for _ in range(repeat):
+            for lat, long in points:
+                before = clock()
+                query(lat, long)
+                latencies.append(clock() - before)
+
+    return latencies, clock() - start
+
+
+
+
+def _percentile(sorted_values, percent):
+
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(percent / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+
+
+#
+# Runs one engine on one workload
+#
+def benchmark(data_file, engine, workload, points, repeat=1):
+
+    tester, mode, load_seconds, index_seconds = load_engine(data_file, engine)
+
+    # The first pass also builds what is built lazily (e.g. the slabs of the polygons),
+    # it is reported separately and not included in the latencies.
+    _, warmup_seconds = _run_queries(tester, mode, points, 1)
+    if hasattr(tester, 'cache_clear'):
+        tester.cache_clear()
+
+    latencies, total_seconds = _run_queries(tester, mode, points, repeat)
+    latencies.sort()
+
+    result = {
+        'engine': engine,
+        'workload': workload,
+        'queries': len(points) * repeat,
+        'load_seconds': round(load_seconds, 6),
+        'index_seconds': round(index_seconds, 6),
+        'warmup_seconds': round(warmup_seconds, 6),
+        'total_seconds': round(total_seconds, 6),
+        'queries_per_second': round(len(points) * repeat / total_seconds, 1) if total_seconds > 0 else None,
+        'latency_us': dict(('p{0}'.format(p), round(_percentile(latencies, p) * 1e6, 3) if latencies else None)
+                           for p in (50, 90, 99, 100)),
+    }
+    if mode in ('batch', 'sweep'):
+        result['latency_us']['note'] = 'average per geoposition of each batch call'
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        tester, mode, _, _ = load_engine(data_file, engine)
+        _run_queries(tester, mode, points, 1)
+        result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result
+
+
+
+
+#
+# Runs all given engines on all given workloads and returns the report (a dict, see above)
+#
+def run_benchmark(data_file, engines=None, workloads=None, count=10000, repeat=1, seed=42):
+
+    engines = engines or sorted(ENGINES)
+    workloads = workloads or WORKLOADS
+
+    # The workloads are generated once, with the default engine
+    generator, _, _, _ = load_engine(data_file, 'grid')
+    points = dict((workload, make_workload(workload, generator, count, seed)) for workload in workloads)
+
+    results = []
+    for engine in engines:
+        for workload in workloads:
+            results.append(benchmark(data_file, engine, workload, points[workload], repeat))
+
+    return {
+        'meta': {
+            'data_file': data_file,
+            'seed': seed,
+            'count': count,
+            'repeat': repeat,
+            'python': platform.python_version(),
+            'numpy': np.__version__ if np is not None else None,
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Benchmark of the state determination.")
+    parser.add_argument("--data", default="states-US.bin", help="states file (default: states-US.bin)")
+    parser.add_argument("--engines", default=",".join(sorted(ENGINES)),
+                        help="comma separated engines (default: all): " + ", ".join(sorted(ENGINES)))
+    parser.add_argument("--workloads", default=",".join(WORKLOADS),
+                        help="comma separated workloads (default: all): " + ", ".join(WORKLOADS))
+    parser.add_argument("--count", type=int, default=10000, help="geopositions per workload (default: 10000)")
+    parser.add_argument("--repeat", type=int, default=1, help="repetitions of each workload (default: 1)")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the workloads (default: 42)")
+    parser.add_argument("--output", default="-", help="output JSON file (default: stdout)")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.data, args.engines.split(","), args.workloads.split(","),
+                           args.count, args.repeat, args.seed)
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as file:
+            file.write(text + "\n")
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,838 @@
+"""
+
+In-memory and on-disk formats of the state borders data.
+
+state_borders_generator.py produces a dictionary of states:
+
+    { 'PA': { 'polygons':     [ [ (lat, long), (lat, long), ... ], ... ],
+              'polygon_info': [ { 'bbox': { 'N': lat, 'E': long, 'S': lat, 'W': long },
+                                  'vertices': count, 'area': square degrees }, ... ],
+              'rectangle':    { 'N': lat, 'E': long, 'S': lat, 'W': long },
+              'simplified':   { 'polygons': [ ... ], 'tolerance': degrees } },     (optional)
+      ... }
+
+and serializes it with pickle (states-US-pickle2.dat) and in the binary format
+described below (states-US.bin).
+
+The simplified polygons are the same polygons with fewer vertices (Douglas-Peucker):
+every point of a polygon is at most 'tolerance' away from its simplified polygon.
+
+The rectangle of a state is the smallest one containing all its polygons. For a state
+with polygons on both sides of the antimeridian (AK), this is a rectangle across the
+antimeridian: then W > E, and the rectangle covers the longitudes >= W and <= E.
+The polygons themselves never cross the antimeridian.
+
+state_determination.py keeps the polygons in a compact form instead:
+
+    { 'PA': { 'lats':      array of the latitudes of all vertices of the state,
+              'longs':     array of the longitudes of all vertices of the state,
+              'rings':     array with the offsets of the rings (polygons) in lats/longs,
+                           i.e. ring r is lats[rings[r]:rings[r+1]],
+              'ring_info': array with S, N, W, E and area of each ring (5 numbers per ring),
+              'rectangle': { 'N': lat, 'E': long, 'S': lat, 'W': long },
+              'simplified': { 'lats': ..., 'longs': ..., 'rings': ..., 'tolerance': degrees },
+              'topology':  { 'arcs': arcs, 'refs': ..., 'rings': ... } },      (optional)
+      ... }
+
+Every ring is closed (first vertex = last vertex), so edge j of a ring always goes
+from vertex j to vertex j+1.
+
+Neighbouring states have their common border in both their rings. build_topology() stores
+such borders only once: the rings are cut into arcs at the junctions (vertices where more
+than two rings meet, or where a ring leaves a border), and each ring is the sequence of its
+arcs, every arc in the direction of the ring:
+
+    arcs      { 'lats': ..., 'longs': ...,     the vertices of all arcs
+                'offsets': ... }               arc i is lats[offsets[i]:offsets[i+1]]
+    refs      the arcs of the rings of a state: i for arc i in its own direction,
+              ~i (= -i-1) for arc i reversed
+    rings     ring r consists of the arcs refs[rings[r]:rings[r+1]]
+
+The last vertex of each arc is the first vertex of the next one, and the last arc of a ring
+ends where its first arc starts. A border of two states is one arc in the rings of both.
+
+
+Binary format (all numbers little-endian, all sections 8-byte aligned)
+----------------------------------------------------------------------
+
+    header        magic "STBORDER", version (uint32), number of states (uint32),
+                  file offsets of the rings, lats, longs, simplified rings, simplified lats,
+                  simplified longs and ring info sections, of the layer table
+                  (0 if there are no child layers) and of the arcs and arc refs sections
+                  (0 if the polygons are not stored as arcs) (10 x uint64)
+    state table   per state: abbreviation (16 bytes, ASCII), N, E, S, W, tolerance (5 x float64),
+                  first vertex, vertex count, first ring offset, ring count,
+                  and the same for the simplified polygons (8 x uint64)
+    rings         ring offsets of all states (int64), ring count + 1 per state,
+                  relative to the first vertex of the state
+    lats          latitudes of all vertices (float64)
+    longs         longitudes of all vertices (float64)
+    simplified    rings, lats and longs of the simplified polygons, like above
+                  (a state without simplified polygons has ring count 0 there)
+    ring info     S, N, W, E and area of each ring (5 x float64 per ring); the ring info
+                  of state i starts at ring number (first ring offset - i)
+
+With the polygons stored as arcs (state_borders_generator.py --topology), the lats and longs
+sections are empty, and the first vertex, vertex count and ring offsets in the state table
+refer to the arc refs instead:
+
+    arcs          number of arcs (uint64), arc offsets (int64, number of arcs + 1),
+                  lats and longs of the vertices of all arcs (float64)
+    arc refs      the arc refs of all states (int64), see build_topology()
+
+Child layers (e.g. counties and ZCTAs below the states) follow the states in the same file:
+
+    layer table   number of layers (uint64), per layer: name (16 bytes, ASCII), file offsets
+                  of its block and of its children, number of features of the layer above
+                  (3 x uint64)
+    block         the features of the layer, in the format above (header, state table,
+                  sections); the offsets in its header are relative to the start of the block
+    children      per feature of the layer above: offset of its first child (int64), number
+                  of features above + 1 numbers, then the children as positions in the
+                  state table of the block (int64)
+
+Each layer is the child layer of the one before it (the first one of the states). A child
+is listed under every feature of the layer above whose polygons it may overlap.
+
+Version 1 files (without the simplified polygons), version 2 files (without the ring
+info), version 3 files (without child layers) and version 4 files (without arcs) can still
+be read, the ring info is computed for versions 1 and 2.
+
+read_borders() maps the file into memory with mmap and returns the compact form (and,
+with_layers, the child layers from the same mapping) with memoryviews on the mapped file
+instead of arrays. Nothing is copied, so all processes using the same file share its pages
+through the OS page cache.
+Polygons stored as arcs are only put together into lats, longs and rings arrays of a
+state when these are used (see arc_state); state_determination tests geopositions and
+builds its grid index on the arcs themselves, which stay on the mapped file.
+
+
+Raster format (state_raster_generator.py, all numbers little-endian)
+---------------------------------------------------------------------
+
+A grid of square cells (cell size in degrees, origin = southwest corner of the
+bounding boxes of all polygons), each cell is outside of all states (value 0),
+entirely inside one state (value 1 ... number of states) or a border cell which
+needs the polygon test (value RASTER_BORDER). Each row is run-length encoded:
+
+    header        magic "STRASTER", version (uint32), number of states (uint32),
+                  lat and long of the origin, cell size (3 x float64),
+                  rows, cols, runs (3 x uint64)
+    states        abbreviation of each state (16 bytes, ASCII), value = position + 1
+    row offsets   first run of each row (uint64), rows + 1 numbers
+    run starts    first col of each run (uint32), the first run of a row starts at col 0
+    run values    value of each run (uint16)
+
+read_raster() maps the file into memory like read_borders().
+
+"""
+
+from __future__ import division, print_function
+
+from array import array
+import mmap
+import struct
+import sys
+
+
+
+MAGIC = b"STBORDER"
+VERSION = 5
+
+HEADER = struct.Struct("<8sII10Q")
+STATE_ENTRY = struct.Struct("<16s5d8Q")
+LAYER_COUNT = struct.Struct("<Q")
+LAYER_ENTRY = struct.Struct("<16s3Q")
+
+HEADER_V4 = struct.Struct("<8sII8Q")
+HEADER_V3 = struct.Struct("<8sII7Q")
+HEADER_V2 = struct.Struct("<8sII6Q")
+HEADER_V1 = struct.Struct("<8sII3Q")
+STATE_ENTRY_V1 = struct.Struct("<16s4d4Q")
+
+RASTER_MAGIC = b"STRASTER"
+RASTER_VERSION = 1
+RASTER_HEADER = struct.Struct("<8sII3d3Q")
+RASTER_STATE = struct.Struct("<16s")
+RASTER_BORDER = 0xFFFF
+
+# Bytes per number in the files, by array typecode ('l' is 'q' on Py 2)
+_ITEM_SIZE = {'d': 8, 'q': 8, 'l': 8, 'I': 4, 'H': 2}
+
+
+
+#
+# Converts the states from the generator's form (lists of (lat, long) tuples per polygon)
+# into the compact form, see above.
+# Closing a ring only adds an edge of length 0, so the winding numbers are the same as
+# for the original polygon.
+#
+def compact_states(states):
+
+    compact = dict()
+    for state_abbrev, state_data in states.items():
+        compact[state_abbrev] = _compact_polygons(state_data['polygons'])
+        if 'polygon_info' in state_data:
+            info = array('d')
+            for polygon_info in state_data['polygon_info']:
+                bbox = polygon_info['bbox']
+                info.extend((bbox['S'], bbox['N'], bbox['W'], bbox['E'], polygon_info['area']))
+        else:
+            info = ring_info(compact[state_abbrev]['lats'], compact[state_abbrev]['longs'],
+                             compact[state_abbrev]['rings'])
+        compact[state_abbrev]['ring_info'] = info
+        compact[state_abbrev]['rectangle'] = bounding_rectangle(info)
+
+        if 'simplified' in state_data:
+            simplified = _compact_polygons(state_data['simplified']['polygons'])
+            simplified['tolerance'] = state_data['simplified']['tolerance']
+            compact[state_abbrev]['simplified'] = simplified
+
+    return compact
+
+
+
+
+def _compact_polygons(polygons):
+
+    lats, longs, rings = array('d'), array('d'), array('l', [0])
+
+    for poly in polygons:
+        for point in poly:
+            lats.append(point[0])
+            longs.append(point[1])
+        if len(poly) > 0 and tuple(poly[0]) != tuple(poly[-1]):
+            lats.append(poly[0][0])
+            longs.append(poly[0][1])
+        rings.append(len(lats))
+
+    return {'lats': lats, 'longs': longs, 'rings': rings}
+
+
+
+
+#
+# Bounding box and area of a polygon: (S, N, W, E, area)
+# The area is in square degrees (lat and long taken as plane coordinates).
+#
+def polygon_info(lats, longs):
+
+    if len(lats) == 0:
+        return (float('inf'), float('-inf'), float('inf'), float('-inf'), 0.0)
+
+    # Shoelace formula, including the closing edge (of length 0 for a closed ring)
+    area = longs[-1] * lats[0] - longs[0] * lats[-1]
+    for j in range(len(lats) - 1):
+        area += longs[j] * lats[j+1] - longs[j+1] * lats[j]
+
+    return (min(lats), max(lats), min(longs), max(longs), abs(area) / 2)
+
+
+
+
+#
+# The ring info of all rings of a state (compact form): array with S, N, W, E, area per ring
+#
+def ring_info(lats, longs, rings):
+
+    info = array('d')
+    for r in range(len(rings) - 1):
+        info.extend(polygon_info(lats[rings[r]:rings[r+1]], longs[rings[r]:rings[r+1]]))
+    return info
+
+
+
+
+#
+# The rings of a state in the order they should be tested: largest area first
+#
+def ring_order(info):
+
+    return sorted(range(len(info) // 5), key=lambda r: -info[5 * r + 4])
+
+
+
+
+#
+# The rectangle of a state, from the bounding boxes of its rings (see ring_info).
+# The longitudes are treated as a circle: the rectangle leaves out the largest gap
+# between the rings. If that gap is not the one at the antimeridian, the rectangle
+# crosses the antimeridian (W > E).
+#
+def bounding_rectangle(info):
+
+    boxes = [info[5 * r:5 * r + 4] for r in range(len(info) // 5) if info[5 * r] <= info[5 * r + 1]]
+    if not boxes:
+        return {'N': None, 'E': None, 'S': None, 'W': None}
+
+    # Longitude intervals of the rings, merged where they overlap
+    intervals = []
+    for _, _, west, east in sorted(boxes, key=lambda box: box[2]):
+        if intervals and west <= intervals[-1][1]:
+            intervals[-1][1] = max(intervals[-1][1], east)
+        else:
+            intervals.append([west, east])
+
+    # The gap at the antimeridian, and the largest gap between two intervals
+    west, east = intervals[0][0], intervals[-1][1]
+    gap = west + 360.0 - east
+    for i in range(1, len(intervals)):
+        if intervals[i][0] - intervals[i-1][1] > gap:
+            gap = intervals[i][0] - intervals[i-1][1]
+            west, east = intervals[i][0], intervals[i-1][1]
+
+    return {'N': max(box[1] for box in boxes), 'E': east, 'S': min(box[0] for box in boxes), 'W': west}
+
+
+
+
+#
+# Cuts the rings of the states (compact form) into arcs, each common border only once
+# (see above).
+#
+#     Input:  states    - states in compact form
+#     Return: arcs      - { 'lats': array, 'longs': array, 'offsets': array }
+#             topology  - { state: { 'refs': array of arc refs, 'rings': array of ring offsets } }
+#
+# A junction is a vertex which has different neighbours in two of its rings. The rings
+# are cut at their junctions, so two rings with a common border both have it as one arc
+# between the same two junctions, the same vertices once forward and once backward.
+# A ring without junctions is one arc, starting at its smallest vertex.
+#
+def build_topology(states):
+
+    rings = []
+    for state_abbrev, state_data in states.items():
+        lats, longs, offsets = state_data['lats'], state_data['longs'], state_data['rings']
+        for r in range(len(offsets) - 1):
+            points = list(zip(lats[offsets[r]:offsets[r+1]], longs[offsets[r]:offsets[r+1]]))
+            if len(points) > 1 and points[0] == points[-1]:
+                del points[-1]
+            rings.append((state_abbrev, points))
+
+    # The junctions
+    neighbours = dict()
+    junctions = set()
+    for _, points in rings:
+        for i, point in enumerate(points):
+            pair = tuple(sorted((points[i-1], points[(i+1) % len(points)])))
+            if neighbours.setdefault(point, pair) != pair:
+                junctions.add(point)
+
+    arcs = {'lats': array('d'), 'longs': array('d'), 'offsets': array('l', [0])}
+    arc_numbers = dict()
+    topology = dict((state_abbrev, {'refs': array('l'), 'rings': array('l', [0])}) for state_abbrev in states)
+
+    for state_abbrev, points in rings:
+        refs = topology[state_abbrev]['refs']
+
+        if points:
+            # Start at a junction (or at the smallest vertex), end at the same vertex again
+            first = next((i for i, point in enumerate(points) if point in junctions),
+                         points.index(min(points)))
+            points = points[first:] + points[:first] + [points[first]]
+
+            arc = [points[0]]
+            for point in points[1:]:
+                arc.append(point)
+                if point in junctions or len(arc) == len(points):
+                    refs.append(_arc_ref(tuple(arc), arcs, arc_numbers))
+                    arc = [point]
+
+        topology[state_abbrev]['rings'].append(len(refs))
+
+    return arcs, topology
+
+
+
+
+#
+# The ref of an arc (see above): the number of the stored arc with the same vertices in the
+# same or reverse direction, a new arc is stored if there is none.
+#
+def _arc_ref(arc, arcs, arc_numbers):
+
+    number = arc_numbers.get(arc)
+    if number is not None:
+        return number
+    number = arc_numbers.get(arc[::-1])
+    if number is not None:
+        return ~number
+
+    number = arc_numbers[arc] = len(arcs['offsets']) - 1
+    for lat, long in arc:
+        arcs['lats'].append(lat)
+        arcs['longs'].append(long)
+    arcs['offsets'].append(len(arcs['lats']))
+    return number
+
+
+
+
+#
+# Puts the rings of a state together from its arcs (see build_topology):
+# returns lats, longs and rings like in the compact form
+#
+def arc_polygons(arcs, refs, rings):
+
+    arc_lats, arc_longs, offsets = arcs['lats'], arcs['longs'], arcs['offsets']
+    lats, longs, vertex_rings = array('d'), array('d'), array('l', [0])
+
+    for r in range(len(rings) - 1):
+        for i in range(rings[r], rings[r+1]):
+            arc = refs[i] if refs[i] >= 0 else ~refs[i]
+            start, stop = offsets[arc], offsets[arc+1]
+            if refs[i] >= 0:
+                arc_range = range(start, stop)
+            else:
+                arc_range = range(stop - 1, start - 1, -1)
+            if i > rings[r]:
+                arc_range = arc_range[1:]           # the last vertex of the previous arc
+            lats.extend(arc_lats[j] for j in arc_range)
+            longs.extend(arc_longs[j] for j in arc_range)
+        vertex_rings.append(len(lats))
+
+    return lats, longs, vertex_rings
+
+
+
+
+#
+# A state stored as arcs (compact form with 'topology'): lats, longs and rings are put
+# together from the arcs (arc_polygons) on first use, so a state which is only ever
+# tested on its arcs keeps all its geometry on the mapped file.
+#
+class arc_state(dict):
+
+    def __missing__(self, key):
+
+        if key not in ('lats', 'longs', 'rings'):
+            raise KeyError(key)
+        topology = self['topology']
+        self['lats'], self['longs'], self['rings'] = arc_polygons(topology['arcs'], topology['refs'],
+                                                                  topology['rings'])
+        return self[key]
+
+
+
+
+#
+# Returns True if the file starts with the magic bytes of the binary format
+#
+def is_binary_borders(filename):
+
+    with open(filename, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+
+
+#
+# Writes the states (generator's form or compact form) in the binary format,
+# optionally with child layers (see above):
+#
+#     layers    - list of (name, features, children): features like states, children maps the
+#                 key of each feature of the layer above (the states for the first layer) to
+#                 the list of keys of its children in this layer
+#     topology  - True: the polygons (of the states and of all layers) are stored as arcs,
+#                 see build_topology()
+#
+def write_borders(states, filename, layers=(), topology=False):
+
+    with open(filename, "wb") as file:
+        keys = _write_block(file, states, 0, topology)
+        if not layers:
+            return
+
+        # The layer table, filled in when the positions are known
+        layers_pos = file.tell()
+        file.write(LAYER_COUNT.pack(len(layers)) + b"\0" * (LAYER_ENTRY.size * len(layers)))
+        file.write(b"\0" * (-file.tell() % 8))
+
+        entries = []
+        for name, features, children in layers:
+            block_pos = file.tell()
+            child_keys = _write_block(file, features, block_pos, topology)
+
+            # Children of each feature of the layer above: offsets (parent count + 1), child indexes
+            children_pos = file.tell()
+            positions = dict((key, i) for i, key in enumerate(child_keys))
+            offsets, indexes = array('l', [0]), array('l')
+            for key in keys:
+                indexes.extend(positions[child] for child in children.get(key, ()))
+                offsets.append(len(indexes))
+            _write_array(file, 'q', offsets)
+            _write_array(file, 'q', indexes)
+
+            entries.append(LAYER_ENTRY.pack(_encode_key(name), block_pos, children_pos, len(keys)))
+            keys = child_keys
+
+        file.seek(layers_pos)
+        file.write(LAYER_COUNT.pack(len(layers)) + b"".join(entries))
+
+        # The position of the layer table, the eighth number of the header
+        file.seek(HEADER_V3.size)
+        file.write(struct.pack("<Q", layers_pos))
+
+
+
+
+#
+# Writes one block in the binary format (header, state table and sections) at the current
+# position base of the file, with the section positions relative to base.
+# Returns the keys of the states in the order of the state table.
+#
+def _write_block(file, states, base, topology=False):
+
+    if any('polygons' in state_data for state_data in states.values()):
+        states = compact_states(states)
+
+    abbrevs = list(states.keys())
+    exact = [states[abbrev] for abbrev in abbrevs]
+    simplified = [states[abbrev].get('simplified', _NO_POLYGONS) for abbrev in abbrevs]
+
+    infos = [state_data.get('ring_info') or ring_info(state_data['lats'], state_data['longs'], state_data['rings'])
+             for state_data in exact]
+
+    if topology:
+        # The rings as arc refs, in place of the vertices
+        arcs, arc_rings = build_topology(states)
+        exact = [dict(state_data, lats=(), longs=(), rings=arc_rings[abbrev]['rings'], refs=arc_rings[abbrev]['refs'])
+                 for abbrev, state_data in zip(abbrevs, exact)]
+
+    rings_pos = HEADER.size + STATE_ENTRY.size * len(abbrevs)
+    rings_pos += -rings_pos % 8
+    lats_pos, longs_pos, end_pos = _section_positions(exact, rings_pos)
+    simple_rings_pos = end_pos
+    simple_lats_pos, simple_longs_pos, info_pos = _section_positions(simplified, simple_rings_pos)
+
+    arcs_pos = refs_pos = 0
+    if topology:
+        arcs_pos = info_pos + 8 * sum(len(info) for info in infos)
+        refs_pos = arcs_pos + 8 * (1 + len(arcs['offsets']) + 2 * len(arcs['lats']))
+
+    file.write(HEADER.pack(MAGIC, VERSION, len(abbrevs), rings_pos, lats_pos, longs_pos,
+                           simple_rings_pos, simple_lats_pos, simple_longs_pos, info_pos, 0, arcs_pos, refs_pos))
+
+    vertex_start, ring_start, simple_vertex_start, simple_ring_start = 0, 0, 0, 0
+    for abbrev, state_data, simple_data in zip(abbrevs, exact, simplified):
+        rectangle = state_data['rectangle']
+        vertex_count = len(state_data['refs'] if topology else state_data['lats'])
+        file.write(STATE_ENTRY.pack(_encode_key(abbrev),
+                                    rectangle['N'], rectangle['E'], rectangle['S'], rectangle['W'],
+                                    simple_data.get('tolerance', 0.0),
+                                    vertex_start, vertex_count,
+                                    ring_start, len(state_data['rings']) - 1,
+                                    simple_vertex_start, len(simple_data['lats']),
+                                    simple_ring_start, len(simple_data['rings']) - 1))
+        vertex_start += vertex_count
+        ring_start += len(state_data['rings'])
+        simple_vertex_start += len(simple_data['lats'])
+        simple_ring_start += len(simple_data['rings'])
+
+    file.write(b"\0" * (base + rings_pos - file.tell()))
+    for polygons in (exact, simplified):
+        for data in polygons:
+            _write_array(file, 'q', data['rings'])
+        for key in ('lats', 'longs'):
+            for data in polygons:
+                _write_array(file, 'd', data[key])
+    for info in infos:
+        _write_array(file, 'd', info)
+
+    if topology:
+        _write_array(file, 'q', [len(arcs['offsets']) - 1])
+        _write_array(file, 'q', arcs['offsets'])
+        _write_array(file, 'd', arcs['lats'])
+        _write_array(file, 'd', arcs['longs'])
+        for state_data in exact:
+            _write_array(file, 'q', state_data['refs'])
+
+    return abbrevs
+
+
+
+
+#
+# The key of a state (or of a feature of a layer) as 16 bytes ASCII
+#
+def _encode_key(key):
+
+    encoded = key.encode("ascii")
+    if len(encoded) > 16:
+        raise ValueError("Key {0!r} is longer than 16 characters".format(key))
+    return encoded
+
+
+
+
+# Placeholder for states without simplified polygons: no rings, no vertices
+_NO_POLYGONS = {'lats': (), 'longs': (), 'rings': (0,)}
+
+
+
+
+#
+# The positions of the lats and longs sections (and the end of the longs section),
+# if the rings section of these polygons starts at rings_pos
+#
+def _section_positions(polygons, rings_pos):
+
+    lats_pos = rings_pos + 8 * sum(len(data['rings']) for data in polygons)
+    longs_pos = lats_pos + 8 * sum(len(data['lats']) for data in polygons)
+    return lats_pos, longs_pos, longs_pos + (longs_pos - lats_pos)
+
+
+
+
+def _write_array(file, typecode, values):
+
+    if sys.version_info.major == 2 and typecode == 'q':
+        typecode = 'l'
+    values = array(typecode, values)
+    if values.itemsize != _ITEM_SIZE[typecode]:
+        raise ValueError("array('{0}') has {1} bytes per item".format(typecode, values.itemsize))
+    if sys.byteorder != "little":
+        values.byteswap()
+    file.write(values.tostring() if sys.version_info.major == 2 else values.tobytes())
+
+
+
+
+#
+# Maps a file in the binary format into memory and returns the states in compact form.
+# lats, longs and rings of each state are (read-only) views on the mapped file.
+#
+# with_layers: returns (states, layers) instead, with the child layers of the file (see
+# above) from the same mapping, as list of (name, features, children): features in compact
+# form like the states, children maps the key of each feature of the layer above to the
+# tuple of the keys of its children. Files without child layers have an empty list.
+#
+def read_borders(filename, with_layers=False):
+
+    data = _map_file(filename)
+    keys, states, layers_pos = _read_block(data, 0, filename, with_keys=True)
+    if not with_layers:
+        return states
+
+    layers = []
+    count = LAYER_COUNT.unpack_from(data, layers_pos)[0] if layers_pos else 0
+    for i in range(count):
+        name, block_pos, children_pos, parent_count = LAYER_ENTRY.unpack_from(data, layers_pos + LAYER_COUNT.size
+                                                                                  + i * LAYER_ENTRY.size)
+        child_keys, features, _ = _read_block(data, block_pos, filename, with_keys=True)
+
+        offsets = _view(data, 'q', children_pos, parent_count + 1)
+        indexes = _view(data, 'q', children_pos + 8 * (parent_count + 1), offsets[parent_count])
+        children = dict((keys[p], tuple(child_keys[indexes[c]] for c in range(offsets[p], offsets[p + 1])))
+                        for p in range(parent_count))
+
+        layers.append((name.rstrip(b"\0").decode("ascii"), features, children))
+        keys = child_keys
+
+    return states, layers
+
+
+
+
+def _map_file(filename):
+
+    with open(filename, "rb") as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+
+
+#
+# Reads one block (header, state table and sections) at position base of the mapped file.
+# Returns the states in compact form, with_keys: (keys in the order of the state table,
+# states, position of the layer table).
+#
+def _read_block(data, base, filename, with_keys=False):
+
+    magic, version, state_count = HEADER_V1.unpack_from(data, base)[:3]
+    if magic != MAGIC:
+        raise ValueError("{0} is not a state borders file".format(filename))
+    if version not in (1, 2, 3, 4, VERSION):
+        raise ValueError("{0} has format version {1}, expected {2}".format(filename, version, VERSION))
+
+    info_pos = None
+    layers_pos = arcs_pos = 0
+    if version == 1:
+        rings_pos, lats_pos, longs_pos = HEADER_V1.unpack_from(data, base)[3:]
+        entry, entry_pos = STATE_ENTRY_V1, HEADER_V1.size
+    elif version == 2:
+        (rings_pos, lats_pos, longs_pos,
+         simple_rings_pos, simple_lats_pos, simple_longs_pos) = HEADER_V2.unpack_from(data, base)[3:]
+        entry, entry_pos = STATE_ENTRY, HEADER_V2.size
+    elif version == 3:
+        (rings_pos, lats_pos, longs_pos,
+         simple_rings_pos, simple_lats_pos, simple_longs_pos, info_pos) = HEADER_V3.unpack_from(data, base)[3:]
+        entry, entry_pos = STATE_ENTRY, HEADER_V3.size
+    elif version == 4:
+        (rings_pos, lats_pos, longs_pos,
+         simple_rings_pos, simple_lats_pos, simple_longs_pos, info_pos, layers_pos) = HEADER_V4.unpack_from(data, base)[3:]
+        entry, entry_pos = STATE_ENTRY, HEADER_V4.size
+    else:
+        (rings_pos, lats_pos, longs_pos, simple_rings_pos, simple_lats_pos, simple_longs_pos,
+         info_pos, layers_pos, arcs_pos, refs_pos) = HEADER.unpack_from(data, base)[3:]
+        entry, entry_pos = STATE_ENTRY, HEADER.size
+
+    # (the positions in the header are relative to the start of the block)
+    rings_pos, lats_pos, longs_pos = base + rings_pos, base + lats_pos, base + longs_pos
+    if version > 1:
+        simple_rings_pos, simple_lats_pos, simple_longs_pos = (base + simple_rings_pos, base + simple_lats_pos,
+                                                               base + simple_longs_pos)
+    if info_pos is not None:
+        info_pos += base
+
+    if arcs_pos:
+        arcs_pos, refs_pos = base + arcs_pos, base + refs_pos
+        arc_count = LAYER_COUNT.unpack_from(data, arcs_pos)[0]
+        offsets = _view(data, 'q', arcs_pos + 8, arc_count + 1)
+        vertices_pos = arcs_pos + 8 * (arc_count + 2)
+        arcs = {'lats': _view(data, 'd', vertices_pos, offsets[arc_count]),
+                'longs': _view(data, 'd', vertices_pos + 8 * offsets[arc_count], offsets[arc_count]),
+                'offsets': offsets}
+
+    keys = []
+    states = dict()
+    for i in range(state_count):
+        values = entry.unpack_from(data, base + entry_pos + i * entry.size)
+        abbrev, (north, east, south, west) = values[0], values[1:5]
+        if version == 1:
+            tolerance = 0.0
+            vertex_start, vertex_count, ring_start, ring_count = values[5:]
+            simple_ring_count = 0
+        else:
+            tolerance = values[5]
+            (vertex_start, vertex_count, ring_start, ring_count,
+             simple_vertex_start, simple_vertex_count, simple_ring_start, simple_ring_count) = values[6:]
+
+        rings = _view(data, 'q', rings_pos + 8 * ring_start, ring_count + 1)
+        if arcs_pos:
+            # (the vertex start and count are those of the arc refs)
+            state_data = arc_state(topology={'arcs': arcs, 'rings': rings,
+                                             'refs': _view(data, 'q', refs_pos + 8 * vertex_start, vertex_count)})
+        else:
+            state_data = {
+                'lats': _view(data, 'd', lats_pos + 8 * vertex_start, vertex_count),
+                'longs': _view(data, 'd', longs_pos + 8 * vertex_start, vertex_count),
+                'rings': rings,
+            }
+        state_data['rectangle'] = {'N': north, 'E': east, 'S': south, 'W': west}
+        if info_pos is not None:
+            state_data['ring_info'] = _view(data, 'd', info_pos + 40 * (ring_start - i), 5 * ring_count)
+        else:
+            # Older versions: compute the ring info, and the rectangle from it
+            # (older rectangles do not cross the antimeridian)
+            state_data['ring_info'] = ring_info(state_data['lats'], state_data['longs'], state_data['rings'])
+            state_data['rectangle'] = bounding_rectangle(state_data['ring_info'])
+        if simple_ring_count > 0:
+            state_data['simplified'] = {
+                'lats': _view(data, 'd', simple_lats_pos + 8 * simple_vertex_start, simple_vertex_count),
+                'longs': _view(data, 'd', simple_longs_pos + 8 * simple_vertex_start, simple_vertex_count),
+                'rings': _view(data, 'q', simple_rings_pos + 8 * simple_ring_start, simple_ring_count + 1),
+                'tolerance': tolerance,
+            }
+
+        key = abbrev.rstrip(b"\0").decode("ascii")
+        keys.append(key)
+        states[key] = state_data
+
+    if with_keys:
+        return keys, states, layers_pos
+    return states
+
+
+
+
+#
+# A view of count numbers (typecode 'd', 'q', 'I' or 'H') at position pos of the mapped file.
+# Py 2 and big-endian machines get a copy in an array instead.
+#
+def _view(data, typecode, pos, count):
+
+    size = _ITEM_SIZE[typecode] * count
+    if sys.version_info.major == 2:
+        values = array('l' if typecode == 'q' else typecode)
+        values.fromstring(data[pos:pos + size])
+    elif sys.byteorder != "little":
+        values = array(typecode)
+        values.frombytes(data[pos:pos + size])
+    else:
+        return memoryview(data)[pos:pos + size].cast(typecode)
+
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values
+
+
+
+
+#
+# Writes a raster (dict with the keys of the header, see above, plus 'states',
+# 'row_offsets', 'run_starts' and 'run_values') in the raster format
+#
+def write_raster(raster, filename):
+
+    states_pos = RASTER_HEADER.size
+    offsets_pos = states_pos + RASTER_STATE.size * len(raster['states'])
+    runs = len(raster['run_starts'])
+
+    with open(filename, "wb") as file:
+        file.write(RASTER_HEADER.pack(RASTER_MAGIC, RASTER_VERSION, len(raster['states']),
+                                      raster['lat0'], raster['long0'], raster['cell_size'],
+                                      raster['rows'], raster['cols'], runs))
+        for abbrev in raster['states']:
+            file.write(RASTER_STATE.pack(abbrev.encode("ascii")))
+        file.write(b"\0" * (-offsets_pos % 8))
+        _write_array(file, 'q', raster['row_offsets'])
+        _write_array(file, 'I', raster['run_starts'])
+        _write_array(file, 'H', raster['run_values'])
+
+
+
+
+#
+# Returns True if the file starts with the magic bytes of the raster format
+#
+def is_raster(filename):
+
+    with open(filename, "rb") as file:
+        return file.read(len(RASTER_MAGIC)) == RASTER_MAGIC
+
+
+
+
+#
+# Maps a file in the raster format into memory and returns the raster (see write_raster),
+# row_offsets, run_starts and run_values are (read-only) views on the mapped file.
+#
+def read_raster(filename):
+
+    with open(filename, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    (magic, version, state_count, lat0, long0, cell_size,
+     rows, cols, runs) = RASTER_HEADER.unpack_from(data, 0)
+    if magic != RASTER_MAGIC:
+        raise ValueError("{0} is not a state raster file".format(filename))
+    if version != RASTER_VERSION:
+        raise ValueError("{0} has format version {1}, expected {2}".format(filename, version, RASTER_VERSION))
+
+    states = [RASTER_STATE.unpack_from(data, RASTER_HEADER.size + RASTER_STATE.size * i)[0].rstrip(b"\0").decode("ascii")
+              for i in range(state_count)]
+    offsets_pos = RASTER_HEADER.size + RASTER_STATE.size * state_count
+    offsets_pos += -offsets_pos % 8
+    starts_pos = offsets_pos + 8 * (rows + 1)
+    values_pos = starts_pos + 4 * runs
+
+    return {
+        'lat0': lat0, 'long0': long0, 'cell_size': cell_size, 'rows': rows, 'cols': cols,
+        'states': states,
+        'row_offsets': _view(data, 'q', offsets_pos, rows + 1),
+        'run_starts': _view(data, 'I', starts_pos, runs),
+        'run_values': _view(data, 'H', values_pos, runs),
+        'bytes': len(data),
+    }
@@ -5,14 +5,52 @@ State borders data has been downloaded from https://www.census.gov/geo/maps-data
 The Shapefiles (.shp) from there have been imported with Google Earth Pro and then exported again as .kml file.
 This script transforms the .kml file to a dictionary structure which is - at the end - serialized again using Python pickle library.
 The pickle file can then be used in other scripts.
+The same data is also written in a binary format (see state_borders_format.py) which
+state_determination.py can memory-map instead of unpickling it.
+
+The .kml file is read as a stream (iterparse), every Polygon and Placemark element is
+cleared as soon as it has been processed. So the memory needed does not grow with the
+size of the .kml file, only with the size of the resulting data.
+
+Usage:
+    python state_borders_generator.py [USA.kml] [--pickle states-US-pickle2.dat] [--binary states-US.bin] [--jobs N]
+                                      [--layer NAME=KML_FILE ...] [--topology] [--cache states-US-cache.dat]
+
+With --jobs N the polygons are processed by N worker processes. The result does not
+depend on the number of jobs.
+
+With --layer county=counties.kml --layer zcta=zcta.kml, child layers are generated from
+further .kml files (keys from the GEOID field, see --layer-key) and written into the same
+binary file, each layer below the one before it (see assign_children).
+
+The processed states are kept in a build cache (--cache), keyed by a hash of the content of
+each Placemark. On the next run only the Placemarks which changed (or are new) are processed
+again, all others are taken from the cache (see build_cache).
+
+With --topology the polygons in the binary file are stored as arcs: the common border of two
+states (or counties, ...) only once, see state_borders_format.build_topology.
+
+Besides the polygons themselves, simplified polygons (Douglas-Peucker, --simplify tolerance
+in degrees) are stored. state_determination uses them for geopositions which are farther
+than the tolerance away from the border and the exact polygons only for the others.
 
 """
 
 from __future__ import division, print_function
 
+from array import array
+import argparse
+import functools
+import hashlib
+import itertools
+import math
+import multiprocessing
+import os
 import xml.etree.ElementTree as etree
 import sys
 
+from state_borders_format import bounding_rectangle, polygon_info, write_borders
+
 if sys.version_info.major == 2:
     import cPickle
 else:
@@ -22,85 +60,527 @@ else:
 
 kml_ns = "{http://www.opengis.net/kml/2.2}"
 
-placemarks = etree.parse("USA.kml").getroot().findall(".//{ns}Placemark".format(ns=kml_ns))
-print("Found {0} /Placemark items in the file.".format(len(placemarks)))
 
-usa_states = dict()
 
-for pm in placemarks:
-    state = dict()
-    abbrev = pm.find("{ns}name".format(ns=kml_ns)).text
-    polygon_elems = pm.findall(".//{ns}Polygon".format(ns=kml_ns))
-    print(abbrev, len(polygon_elems))
 
+#
+# Reads the .kml file as a stream and yields the name and the polygons of each Placemark.
+# A polygon is yielded as the text of its (first) coordinates element.
+# With key_field, the value of that field of the Placemark's ExtendedData (e.g. GEOID of
+# the TIGER/Line files) is yielded instead of the name, if the Placemark has it.
+#
+def iter_placemarks(kml_file, key_field=None):
+
+    name = None
+    fields = dict()
     polygons = []
-    rectangle = {'N':None, 'E':None, 'S':None, 'W':None}
+    parents = []        # the elements enclosing the current one
+
+    for event, elem in etree.iterparse(kml_file, events=("start", "end")):
+
+        if event == "start":
+            parents.append(elem)
+            continue
+
+        parents.pop()
+
+        if elem.tag == "{ns}name".format(ns=kml_ns) and parents and parents[-1].tag == "{ns}Placemark".format(ns=kml_ns):
+            name = elem.text
+
+        elif elem.tag == "{ns}Polygon".format(ns=kml_ns):
+            # Get the coordinates element within the polygon element (outer boundary)
+            coordinates_elem = elem.find(".//{ns}coordinates".format(ns=kml_ns))
+            polygons.append(coordinates_elem.text if coordinates_elem is not None else "")
+            elem.clear()
+
+        elif key_field is not None and elem.tag == "{ns}SimpleData".format(ns=kml_ns):
+            fields[elem.get("name")] = elem.text
+
+        elif key_field is not None and elem.tag == "{ns}Data".format(ns=kml_ns):
+            fields[elem.get("name")] = elem.findtext("{ns}value".format(ns=kml_ns))
+
+        elif elem.tag == "{ns}Placemark".format(ns=kml_ns):
+            yield fields.get(key_field) or name, polygons
+            name = None
+            fields = dict()
+            polygons = []
+
+            # Drop the processed Placemark, also from its parent element
+            elem.clear()
+            if parents:
+                parents[-1].remove(elem)
+
+
+
+
+#
+# Parses the text of a coordinates element in a single pass.
+# The text is a whitespace separated list of geopositions in format
+# long,lat[,height] (Note this special order in kml files).
+#
+#     Return: lats, longs  - array('d') with the vertices of the polygon
+#
+def parse_coordinates(text):
+
+    lats, longs = array('d'), array('d')
+    for geopos in text.split():
+        values = geopos.split(',', 2)       # Grab the first two values only (long and lat)
+        longs.append(float(values[0]))
+        lats.append(float(values[1]))
+    return lats, longs
+
+
+
+
+#
+# Simplifies a closed ring with the Douglas-Peucker algorithm.
+# Every vertex which is left out is at most tolerance away from the segment (not only
+# the line) between the two kept vertices around it, so the whole ring is at most
+# tolerance away from the simplified ring.
+#
+#     Input:  lats, longs  - the vertices of a closed ring (first vertex = last vertex)
+#     Return: lats, longs  - the vertices of the simplified (closed) ring
+#
+def simplify_ring(lats, longs, tolerance):
+
+    count = len(lats)
+    if count <= 4:
+        return array('d', lats), array('d', longs)
+
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+
+    # A closed ring starts and ends at the same vertex, so split it at the vertex
+    # farthest away from the start first
+    farthest = max(range(count), key=lambda i: (lats[i] - lats[0]) ** 2 + (longs[i] - longs[0]) ** 2)
+    keep[farthest] = True
+
+    tolerance2 = tolerance * tolerance
+    stack = [(0, farthest), (farthest, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        max_distance2, max_index = -1.0, None
+        for i in range(first + 1, last):
+            distance2 = segment_distance2(lats[i], longs[i], lats[first], longs[first], lats[last], longs[last])
+            if distance2 > max_distance2:
+                max_distance2, max_index = distance2, i
+
+        if max_index is not None and max_distance2 > tolerance2:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, last))
+
+    return (array('d', [lats[i] for i in range(count) if keep[i]]),
+            array('d', [longs[i] for i in range(count) if keep[i]]))
+
+
+
+
+#
+# Squared distance of the point (lat, long) to the segment from (lat1, long1) to (lat2, long2),
+# in degrees (lat and long are treated as plane coordinates, like in the winding number test)
+#
+def segment_distance2(lat, long, lat1, long1, lat2, long2):
+
+    delta_lat, delta_long = lat2 - lat1, long2 - long1
+    length2 = delta_lat * delta_lat + delta_long * delta_long
+    t = 0.0
+    if length2 > 0.0:
+        t = min(1.0, max(0.0, ((lat - lat1) * delta_lat + (long - long1) * delta_long) / length2))
+    lat_diff = lat1 + t * delta_lat - lat
+    long_diff = long1 + t * delta_long - long
+    return lat_diff * lat_diff + long_diff * long_diff
+
+
+
+
+#
+# Processes a single polygon: the work which can be done in parallel in the worker processes
+#
+#     Input:  text         - text of the coordinates element of the polygon
+#             tolerance    - tolerance of the simplified polygon in degrees (0 = no simplified polygon)
+#     Return: lats, longs  - array('d') with the vertices of the polygon, as closed ring
+#             simplified   - (lats, longs) of the simplified polygon, or None
+#             info         - bounding box and area of the polygon (S, N, W, E, area)
+#
+def process_polygon(text, tolerance=0.0):
+
+    lats, longs = parse_coordinates(text)
+
+    # Close the ring, so that edge j always goes from vertex j to vertex j+1
+    if len(lats) > 0 and (lats[0], longs[0]) != (lats[-1], longs[-1]):
+        lats.append(lats[0])
+        longs.append(longs[0])
+
+    simplified = simplify_ring(lats, longs, tolerance) if tolerance > 0 else None
+    return lats, longs, simplified, polygon_info(lats, longs)
+
+
+
+
+#
+# Assembles the processed polygons of one Placemark into the compact form of a state
+# (see state_borders_format.py), including the ring info and the surrounding rectangle.
+#
+def assemble_state(processed_polygons, tolerance=0.0):
+
+    lats, longs, rings, info = array('d'), array('d'), array('l', [0]), array('d')
+    simple_lats, simple_longs, simple_rings = array('d'), array('d'), array('l', [0])
+
+    for poly_lats, poly_longs, simplified, poly_info in processed_polygons:
+        lats.extend(poly_lats)
+        longs.extend(poly_longs)
+        rings.append(len(lats))
+        info.extend(poly_info)
+
+        if simplified is not None:
+            simple_lats.extend(simplified[0])
+            simple_longs.extend(simplified[1])
+            simple_rings.append(len(simple_lats))
+
+    # The northernmost, easternmost, southernmost and westernmost point of all polygons
+    # (across the antimeridian if the polygons are on both sides of it)
+    rectangle = bounding_rectangle(info)
+
+    state = {'lats': lats, 'longs': longs, 'rings': rings, 'ring_info': info, 'rectangle': rectangle}
+    if tolerance > 0:
+        state['simplified'] = {'lats': simple_lats, 'longs': simple_longs, 'rings': simple_rings,
+                               'tolerance': tolerance}
+    return state
+
+
+
+
+#
+# Processes the polygons of one Placemark into the compact form of a state
+#
+def process_placemark(polygon_texts, tolerance=0.0):
+
+    return assemble_state([process_polygon(text, tolerance) for text in polygon_texts], tolerance)
+
+
+
+
+#
+# Reads all Placemarks of the .kml file and returns the dictionary of states (compact form).
+#
+# With jobs > 1 the polygons are processed by a pool of worker processes. The Placemarks
+# are read in windows of a few Placemarks at a time (so memory stays bounded), the polygons
+# of a window are distributed over the workers and the results are merged in the order of
+# the .kml file. So the result is the same for any number of jobs.
+#
+# With a cache (see build_cache), Placemarks whose content is in the cache are not processed
+# again, and a summary of the rebuilt Placemarks is printed at the end. The Placemarks are
+# remembered in the cache under the name of the layer ('states', or the name of a child layer).
+#
+def build_states(kml_file, jobs=1, tolerance=0.0, key_field=None, cache=None, layer="states"):
+
+    usa_states = dict()
+    rebuilt = []
+    placemarks = iter_placemarks(kml_file, key_field)
+
+    def cached_state(abbrev, polygon_texts):
+        if cache is None:
+            return None, None
+        digest = placemark_hash(polygon_texts, tolerance)
+        return digest, cache.get((layer, tolerance, abbrev), digest)
+
+    if jobs <= 1:
+        for abbrev, polygon_texts in placemarks:
+            print(abbrev, len(polygon_texts))
+            digest, state = cached_state(abbrev, polygon_texts)
+            if state is None:
+                state = process_placemark(polygon_texts, tolerance)
+                rebuilt.append(abbrev)
+                if cache is not None:
+                    cache.put(digest, state)
+            usa_states[abbrev] = state
+
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            while True:
+                window = list(itertools.islice(placemarks, 2 * jobs))
+                if not window:
+                    break
+
+                # Only the polygons of the Placemarks which are not in the cache
+                window = [(abbrev, polygon_texts) + cached_state(abbrev, polygon_texts)
+                          for abbrev, polygon_texts in window]
+                texts = [text for _, polygon_texts, _, state in window if state is None for text in polygon_texts]
+                processed = iter(pool.map(functools.partial(process_polygon, tolerance=tolerance), texts,
+                                          chunksize=max(1, len(texts) // (4 * jobs))))
+
+                for abbrev, polygon_texts, digest, state in window:
+                    print(abbrev, len(polygon_texts))
+                    if state is None:
+                        state = assemble_state(list(itertools.islice(processed, len(polygon_texts))), tolerance)
+                        rebuilt.append(abbrev)
+                        if cache is not None:
+                            cache.put(digest, state)
+                    usa_states[abbrev] = state
+        finally:
+            pool.close()
+            pool.join()
+
+    if cache is not None:
+        print("{0}: {1} Placemarks, {2} unchanged (from the cache), {3} rebuilt{4}".format(
+            kml_file, len(usa_states), len(usa_states) - len(rebuilt), len(rebuilt),
+            ": " + ", ".join(rebuilt[:20]) + (", ..." if len(rebuilt) > 20 else "") if rebuilt else ""))
+
+    return usa_states
+
+
+
+
+#
+# Content hash of a Placemark: of the texts of its polygons and of the tolerance of the
+# simplified polygons. Two Placemarks with the same hash give the same state (whatever
+# their names are).
+#
+def placemark_hash(polygon_texts, tolerance=0.0):
+
+    digest = hashlib.sha1("{0} {1!r}".format(build_cache.VERSION, tolerance).encode("ascii"))
+    for text in polygon_texts:
+        digest.update(b"\0")
+        digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+
+
+#
+# Build cache: the processed states (compact form, with ring info, rectangle and simplified
+# polygons) by the content hash of their Placemarks (see placemark_hash), kept in a pickle
+# file from one run to the next. The cache also remembers the hash of each Placemark, by
+# (layer name, tolerance, Placemark key).
+#
+# save() drops the states of Placemarks which changed or were removed in a layer built in
+# this run (with the same tolerance). Everything else is kept, e.g. the states of the child
+# layers when only the states are built, or those of another tolerance. The layer name (not
+# the .kml file name) is the key, so the .kml file of the next TIGER vintage replaces the
+# states of the one before.
+#
+class build_cache:
+
+    # Changes with the processing of the Placemarks or with the keys of the cache, so that
+    # the states of older versions are not reused
+    VERSION = 3
+
+
+
+    def __init__(self, filename):
+
+        self.filename = filename
+        self.states = dict()            # hash -> state
+        self.placemarks = dict()        # (layer, tolerance, key) -> hash
+        self.seen = dict()              # the same for the Placemarks read in this run
+
+        if os.path.exists(filename):
+            try:
+                with open(filename, "rb") as file:
+                    cache = cPickle.load(file)
+                if cache['version'] == self.VERSION:
+                    states, placemarks = cache['states'], cache['placemarks']
+                    if not isinstance(states, dict) or not isinstance(placemarks, dict):
+                        raise TypeError("not a build cache")
+                    self.states, self.placemarks = states, placemarks
+            except Exception as error:
+                print("Warning: cannot read the build cache {0} ({1}: {2}), rebuilding all Placemarks".format(
+                    filename, type(error).__name__, error), file=sys.stderr)
+
+
+
+    #
+    # The state of a Placemark read in this run, None if its hash is not in the cache
+    #
+    def get(self, placemark, digest):
+
+        self.seen[placemark] = digest
+        return self.states.get(digest)
+
+
+
+    def put(self, digest, state):
+
+        self.states[digest] = state
+
+
+
+    #
+    # Writes the cache file (to a temporary file first, which then replaces the cache file,
+    # so an interrupted run never leaves a broken cache behind).
+    # Returns the number of states kept and the number of states dropped.
+    #
+    def save(self):
+
+        sources = set(placemark[:2] for placemark in self.seen)
+        placemarks = dict((placemark, digest) for placemark, digest in self.placemarks.items()
+                          if placemark[:2] not in sources)
+        placemarks.update(self.seen)
+        states = dict((digest, self.states[digest]) for digest in set(placemarks.values()) if digest in self.states)
+
+        temp_filename = self.filename + ".tmp"
+        with open(temp_filename, "wb") as file:
+            cPickle.dump({'version': self.VERSION, 'states': states, 'placemarks': placemarks}, file, 2)
+        getattr(os, "replace", os.rename)(temp_filename, self.filename)        # (Py 2: os.rename)
+
+        return len(states), len(self.states) - len(states)
+
+
+
+
+#
+# Assigns the features of a child layer (e.g. counties) to the features of the layer
+# above (e.g. states): a child is listed under every parent with a ring whose bounding
+# box overlaps the bounding box of one of the child's rings. So the children of a parent
+# include all features which may overlap it (a ZCTA may be listed under several counties).
+#
+#     Return: children  - dict parent key -> list of child keys (in the order of children)
+#
+def assign_children(parents, children, cell_size=1.0):
+
+    # The ring bounding boxes of the parents, in cells of cell_size degrees
+    cells = dict()
+    for parent_key, parent_data in parents.items():
+        info = parent_data['ring_info']
+        for r in range(len(info) // 5):
+            for cell in _box_cells(info[5*r:5*r+4], cell_size):
+                cells.setdefault(cell, []).append((parent_key, info[5*r:5*r+4]))
+
+    assigned = dict((parent_key, []) for parent_key in parents)
+    for child_key, child_data in children.items():
+        info = child_data['ring_info']
+        found = set()
+        for r in range(len(info) // 5):
+            south, north, west, east = info[5*r:5*r+4]
+            for cell in _box_cells(info[5*r:5*r+4], cell_size):
+                for parent_key, (parent_south, parent_north, parent_west, parent_east) in cells.get(cell, ()):
+                    if (parent_key not in found and south <= parent_north and north >= parent_south
+                            and west <= parent_east and east >= parent_west):
+                        found.add(parent_key)
+                        assigned[parent_key].append(child_key)
+
+    return assigned
+
+
+
 
-    for poly_elem in polygon_elems:
+def _box_cells(box, cell_size):
 
-        # the current polygon we are working on, will be collected as a list
-        poly = []
+    south, north, west, east = box
+    if south > north:           # ring without vertices
+        return []
+    return [(row, col) for row in range(int(math.floor(south / cell_size)), int(math.floor(north / cell_size)) + 1)
+            for col in range(int(math.floor(west / cell_size)), int(math.floor(east / cell_size)) + 1)]
 
-        # Get the coordinates element within the polygon element
-        coordinates_elem = poly_elem.find(".//{ns}coordinates".format(ns=kml_ns))
 
-        # Take the text of this coordinates element, split it at whitespace characters.
-        #   Then we have a list of strings where each string is a geoposition in format
-        #   long,lat,height (Note this special order in kml files).
-        geopositions = coordinates_elem.text.split()
 
-        # Go through that list of geoposition strings
-        for geopos in geopositions:
-            lat = float(geopos.split(',')[1])       # Grab the first two values only (lat and long)
-            long = float(geopos.split(',')[0])
 
-            # Check and store if lat is the northernmost or southernmost lat we have so far
-            if rectangle['N'] == None or lat > rectangle['N']:
-                rectangle['N'] = lat
-            if rectangle['S'] == None or lat < rectangle['S']:
-                rectangle['S'] = lat
+#
+# Converts the compact form back into the form stored in the pickle file:
+# a list of (lat, long) tuples per polygon, plus the bounding box, vertex count and area of each polygon
+#
+def to_pickle_form(usa_states):
 
-            # Check and store if long is the easternmost or westernmost long we have so far
-            if rectangle['E'] == None or long > rectangle['E']:
-                rectangle['E'] = long
-            if rectangle['W'] == None or long < rectangle['W']:
-                rectangle['W'] = long
+    pickle_states = dict()
+    for abbrev, state_data in usa_states.items():
+        info = state_data['ring_info']
+        polygons_info = [{'bbox': {'N': info[5*r+1], 'E': info[5*r+3], 'S': info[5*r], 'W': info[5*r+2]},
+                          'vertices': state_data['rings'][r+1] - state_data['rings'][r], 'area': info[5*r+4]}
+                         for r in range(len(state_data['rings']) - 1)]
+        pickle_states[abbrev] = {'polygons': _to_lists(state_data), 'polygon_info': polygons_info,
+                                 'rectangle': state_data['rectangle']}
+        if 'simplified' in state_data:
+            pickle_states[abbrev]['simplified'] = {'polygons': _to_lists(state_data['simplified']),
+                                                   'tolerance': state_data['simplified']['tolerance']}
+    return pickle_states
 
-            # Wrap lat and long as tuple (that's the parantheses) and append to our current polygon
-            poly.append( (lat, long) )
 
-        # add current polygon to our list of polygons
-        polygons.append(poly)
 
 
-    # Now we are done processing all polygons for the current placemark.
+def _to_lists(polygons):
 
-    # We add the polygons and the surrounding rectangle to the current state dictionary
-    state['polygons'] = polygons
-    state['rectangle'] = rectangle
+    lats, longs, rings = polygons['lats'], polygons['longs'], polygons['rings']
+    return [list(zip(lats[rings[r]:rings[r+1]], longs[rings[r]:rings[r+1]])) for r in range(len(rings) - 1)]
 
-    # and add the current state to our big dictionary of states
-    usa_states[abbrev] = state
 
 
-# Loop through all placemark elements is finished here
 
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Generates the state borders data files from a .kml file.")
+    parser.add_argument("kml_file", nargs="?", default="USA.kml", help="input .kml file (default: USA.kml)")
+    parser.add_argument("--pickle", default="states-US-pickle2.dat",
+                        help="output pickle file (default: states-US-pickle2.dat), empty to skip")
+    parser.add_argument("--binary", default="states-US.bin",
+                        help="output binary file (default: states-US.bin), empty to skip")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="number of worker processes (default: 1, 0 = number of CPUs)")
+    parser.add_argument("--simplify", type=float, default=0.01,
+                        help="tolerance of the simplified polygons in degrees (default: 0.01, 0 = none)")
+    parser.add_argument("--layer", action="append", default=[], metavar="NAME=KML_FILE",
+                        help="child layer (e.g. county=counties.kml), below the states or the layer before it; "
+                             "only written to the binary file")
+    parser.add_argument("--layer-key", default="GEOID",
+                        help="ExtendedData field with the keys of the child layer features (default: GEOID, "
+                             "the Placemark name if missing)")
+    parser.add_argument("--cache", default="states-US-cache.dat",
+                        help="build cache file (default: states-US-cache.dat), empty to rebuild everything")
+    parser.add_argument("--topology", action="store_true",
+                        help="store the polygons in the binary file as arcs, each common border only once")
+    args = parser.parse_args(argv)
+
+    layer_files = []
+    for layer in args.layer:
+        name, _, kml_file = layer.partition("=")
+        if not name or not kml_file:
+            parser.error("--layer must be NAME=KML_FILE")
+        layer_files.append((name, kml_file))
 
+    cache = build_cache(args.cache) if args.cache else None
 
-# This is for plausibility, we just count again the items we now have
-print("\n\nUSA states dictionary content:\n")
-for k, v in sorted(usa_states.items()):
-    print(k, len(v['polygons']), v['rectangle'])
+    usa_states = build_states(args.kml_file, args.jobs or multiprocessing.cpu_count(), args.simplify, cache=cache)
+    print("Found {0} /Placemark items in the file.".format(len(usa_states)))
 
 
+    # This is for plausibility, we just count again the items we now have
+    print("\n\nUSA states dictionary content:\n")
+    for k, v in sorted(usa_states.items()):
+        print(k, len(v['rings']) - 1, v['rectangle'])
 
-# Now we store everything into a file using pickle library
-filename = "states-US-pickle2.dat"
-print("Writing to file {0} ... ".format(filename), end="")
-file = open(filename, "wb")
-cPickle.dump(usa_states, file, 2)
-file.close()
-print("Done.")
 
+    # Now we store everything into a file using pickle library
+    if args.pickle:
+        print("Writing to file {0} ... ".format(args.pickle), end="")
+        with open(args.pickle, "wb") as file:
+            cPickle.dump(to_pickle_form(usa_states), file, 2)
+        print("Done.")
 
+    # The child layers, each one assigned to the layer above it
+    layers = []
+    parents = usa_states
+    for name, kml_file in layer_files:
+        features = build_states(kml_file, args.jobs or multiprocessing.cpu_count(), args.simplify, args.layer_key,
+                                cache, name)
+        children = assign_children(parents, features)
+        print("Layer {0}: {1} features, {2} parent-child pairs".format(
+            name, len(features), sum(len(keys) for keys in children.values())))
+        layers.append((name, features, children))
+        parents = features
+
+    # And the same in the binary format, which state_determination can memory-map
+    if args.binary:
+        print("Writing to file {0} ... ".format(args.binary), end="")
+        write_borders(usa_states, args.binary, layers, args.topology)
+        print("Done ({0} bytes).".format(os.path.getsize(args.binary)))
 
+    if cache is not None:
+        print("Writing to file {0} ... ".format(args.cache), end="")
+        kept, dropped = cache.save()
+        print("Done ({0} states, {1} of changed or removed Placemarks dropped).".format(kept, dropped))
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+"""
+
+Bulk geocoding: determines the state for every row of a CSV (or TSV, or Parquet) file with
+lat/long columns.
+
+The input file is read as a stream and split into chunks of rows. The chunks are processed
+by a pool of worker processes, the results are written in the order of the input file.
+All workers share one loaded dataset: the binary states file (states-US.bin) is memory-mapped,
+so the OS page cache holds it only once; a pickle file is loaded once before the workers
+are started and inherited by them. The grid index (about 2.5 s to build for a dense states
+file) is built once in the parent process as well: the workers are forked wherever the
+platform supports it, even if the default start method of multiprocessing is spawn or
+forkserver.
+
+Progress and the final throughput (rows/sec) are reported on stderr.
+
+Usage:
+    python state_bulk_geocoder.py input.csv output.csv [--data states-US.bin] [--jobs N]
+                                  [--lat-column lat] [--long-column long] [--state-column state]
+
+Use - as file name for stdin/stdout. Files ending with .tsv are read and written tab-separated.
+Files ending with .parquet are read and written with pyarrow (optional, only needed for
+Parquet files): the input is read batch by batch, the output has the columns (and column
+types) of the input plus a string column with the state.
+Rows without valid coordinates get an empty state, as well as rows outside of all states
+(null in Parquet files).
+
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import collections
+import csv
+import gc
+import itertools
+import multiprocessing
+import sys
+import time
+
+from state_determination import state_determination
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None      # pyarrow is optional, only needed for Parquet files
+
+
+
+# The dataset of this process, see _init_worker()
+_tester = None
+
+
+
+
+#
+# Opens a CSV file for the csv module (- for stdin/stdout)
+#
+def _open_csv(filename, mode):
+
+    if filename == "-":
+        return sys.stdin if mode == "r" else sys.stdout
+    if sys.version_info.major == 2:
+        return open(filename, mode + "b")
+    return open(filename, mode, newline="")
+
+
+
+
+#
+# Loads the dataset (in the parent process, or in a worker process unless it has
+# been inherited from the parent process). The grid index is built right away, so
+# that forked workers inherit it as well.
+# Loading messages go to stderr, stdout may be the output file.
+#
+def _init_worker(data_file, grid_cell_size):
+
+    global _tester
+    if _tester is None:
+        stdout, sys.stdout = sys.stdout, sys.stderr
+        try:
+            _tester = state_determination(data_file, grid_cell_size)
+            _tester.build_index()
+        finally:
+            sys.stdout = stdout
+
+
+
+
+#
+# Determines the states of a chunk of rows (the work done by the worker processes)
+#
+#     Input:  chunk  - list of (lat, long) string pairs
+#     Return: list of state abbreviations ("" for no state or invalid coordinates)
+#
+def geocode_chunk(chunk):
+
+    states = []
+    for lat, long in chunk:
+        try:
+            state = _tester.state_of_geoposition(float(lat), float(long))
+        except (TypeError, ValueError):         # (TypeError: null in a Parquet file)
+            state = None
+        states.append(state or "")
+    return states
+
+
+
+
+#
+# Splits the rows of a csv.reader into chunks
+#
+def _chunks(rows, chunk_size):
+
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+
+
+#
+# Geocodes all rows of reader and writes them (with an additional state column) to writer.
+# With jobs > 1 at most 2 * jobs chunks are in flight, so memory stays bounded.
+#
+#     Return: number of rows
+#
+def geocode_rows(reader, writer, lat_index, long_index, data_file, grid_cell_size=0.25,
+                 jobs=1, chunk_size=10000, progress=None):
+
+    _init_worker(data_file, grid_cell_size)
+    row_count = 0
+
+    def write(rows, states):
+        for row, state in zip(rows, states):
+            row.append(state)
+        writer.writerows(rows)
+        if progress is not None:
+            progress(len(rows))
+        return len(rows)
+
+    def coords(rows):
+        return [(row[lat_index], row[long_index]) if len(row) > max(lat_index, long_index) else ("", "")
+                for row in rows]
+
+    if jobs <= 1:
+        for rows in _chunks(reader, chunk_size):
+            row_count += write(rows, geocode_chunk(coords(rows)))
+        return row_count
+
+    pool = _worker_pool(jobs, data_file, grid_cell_size)
+    try:
+        pending = collections.deque()
+        for rows in _chunks(reader, chunk_size):
+            pending.append((rows, pool.apply_async(geocode_chunk, (coords(rows),))))
+            if len(pending) >= 2 * jobs:
+                rows, result = pending.popleft()
+                row_count += write(rows, result.get())
+
+        while pending:
+            rows, result = pending.popleft()
+            row_count += write(rows, result.get())
+    finally:
+        pool.close()
+        pool.join()
+        if hasattr(gc, "unfreeze"):
+            gc.unfreeze()
+
+    return row_count
+
+
+
+
+#
+# Starts the worker processes. They are forked if the platform supports it, so that they
+# inherit the dataset and the grid index of this process instead of building their own
+# (with spawn or forkserver, _init_worker loads and indexes the dataset in each worker).
+# gc.freeze() (Python 3.7+) keeps the garbage collector of the workers from writing to the
+# inherited objects, which would give each worker a private copy of their memory pages.
+#
+def _worker_pool(jobs, data_file, grid_cell_size):
+
+    context = multiprocessing
+    if hasattr(multiprocessing, "get_context") and "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    return context.Pool(jobs, _init_worker, (data_file, grid_cell_size))
+
+
+
+
+def _is_parquet(filename):
+
+    return filename.endswith(".parquet")
+
+
+
+
+#
+# Reads the rows of a Parquet file like a csv.reader: the column names first, then each row
+# as a list of values. The file is read one batch of rows at a time, so memory stays bounded.
+#
+def _parquet_rows(parquet_file, batch_size):
+
+    yield list(parquet_file.schema_arrow.names)
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        columns = [column.to_pylist() for column in batch.columns]
+        for row in zip(*columns):
+            yield list(row)
+
+
+
+
+#
+# Writes rows to a Parquet file, like a csv.writer: the first row has the column names. The
+# columns have the types of schema (the schema of a Parquet input file) or are strings (CSV
+# input), the last column is the state (empty state: null).
+#
+class parquet_writer:
+
+    def __init__(self, filename, schema=None):
+
+        self.filename = filename
+        self.schema = schema
+        self.writer = None
+
+
+
+    def writerow(self, header):
+
+        if self.schema is None:
+            self.schema = pyarrow.schema([(name, pyarrow.string()) for name in header[:-1]])
+        self.schema = self.schema.append(pyarrow.field(header[-1], pyarrow.string()))
+        self.writer = pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+
+
+
+    def writerows(self, rows):
+
+        # (short CSV rows are filled up with nulls, the state is always the last column)
+        width = len(self.schema) - 1
+        columns = [list(column) for column in zip(*[(row[:-1] + [None] * width)[:width] for row in rows])]
+        columns.append([row[-1] or None for row in rows])
+        arrays = [pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)]
+        self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+
+
+
+    def close(self):
+
+        if self.writer is not None:
+            self.writer.close()
+
+
+
+
+#
+# Reports rows/sec on stderr, at most every interval seconds and once at the end
+#
+class progress_report:
+
+    def __init__(self, interval=5.0):
+
+        self.interval = interval
+        self.start = self.last = time.time()
+        self.rows = 0
+
+    def __call__(self, rows):
+
+        self.rows += rows
+        now = time.time()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report("...")
+
+    def report(self, prefix=""):
+
+        seconds = max(time.time() - self.start, 1e-9)
+        print("{0}{1} rows in {2:.1f} s, {3:.0f} rows/sec".format(prefix, self.rows, seconds, self.rows / seconds),
+              file=sys.stderr)
+
+
+
+
+def _column_index(header, column):
+
+    if header is not None and column in header:
+        return header.index(column)
+    try:
+        return int(column)
+    except ValueError:
+        raise SystemExit("Column {0} not found in the header of the input file".format(column))
+
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Determines the US state for each row of a CSV (or Parquet) file.")
+    parser.add_argument("input", help="input CSV, TSV or Parquet file with lat/long columns (- for stdin)")
+    parser.add_argument("output", help="output CSV, TSV or Parquet file (- for stdout)")
+    parser.add_argument("--data", default="states-US.bin", help="states file (default: states-US.bin)")
+    parser.add_argument("--jobs", type=int, default=0, help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="rows per chunk (default: 10000)")
+    parser.add_argument("--lat-column", default="lat", help="name or index of the latitude column (default: lat)")
+    parser.add_argument("--long-column", default="long", help="name or index of the longitude column (default: long)")
+    parser.add_argument("--state-column", default="state", help="name of the added column (default: state)")
+    parser.add_argument("--no-header", action="store_true", help="the input CSV file has no header row")
+    parser.add_argument("--grid-cell-size", type=float, default=0.25, help="grid index cell size in degrees")
+    args = parser.parse_args(argv)
+
+    jobs = args.jobs or multiprocessing.cpu_count()
+    delimiter = "\t" if args.input.endswith(".tsv") else ","
+
+    if (_is_parquet(args.input) or _is_parquet(args.output)) and pyarrow is None:
+        parser.error("Parquet files need pyarrow (pip install pyarrow)")
+    if _is_parquet(args.output) and args.no_header and not _is_parquet(args.input):
+        parser.error("a Parquet output file needs the column names from the header row")
+
+    infile = outfile = None
+    try:
+        if _is_parquet(args.input):
+            parquet_file = pyarrow.parquet.ParquetFile(args.input)
+            reader = _parquet_rows(parquet_file, args.chunk_size)      # (the column names are always there)
+        else:
+            infile = _open_csv(args.input, "r")
+            reader = csv.reader(infile, delimiter=delimiter)
+
+        if _is_parquet(args.output):
+            schema = parquet_file.schema_arrow if _is_parquet(args.input) else None
+            outfile = writer = parquet_writer(args.output, schema)
+        else:
+            outfile = _open_csv(args.output, "w")
+            writer = csv.writer(outfile, delimiter="\t" if args.output.endswith(".tsv") else delimiter)
+
+        header = None
+        if not args.no_header or _is_parquet(args.input):
+            header = next(reader, None)
+            if header is not None:
+                writer.writerow(header + [args.state_column])
+
+        _init_worker(args.data, args.grid_cell_size)       # not counted in rows/sec
+        progress = progress_report()
+        geocode_rows(reader, writer, _column_index(header, args.lat_column), _column_index(header, args.long_column),
+                     args.data, args.grid_cell_size, jobs, args.chunk_size, progress)
+        progress.report()
+    finally:
+        if infile is not None and infile is not sys.stdin:
+            infile.close()
+        if outfile is not None and outfile is not sys.stdout:
+            outfile.close()
+
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,36 @@
 from __future__ import division, print_function
-from collections import namedtuple
-from datetime import datetime
+from array import array
+from bisect import bisect_right
+from collections import namedtuple, OrderedDict
+import json
+import math
+import operator
 import sys
 
+from state_borders_format import (RASTER_BORDER, compact_states, is_binary_borders, read_borders,
+                                  read_raster, ring_order)
+
 if sys.version_info.major == 2:
     import cPickle
     from __builtin__ import raw_input as input
 else:
     import pickle as cPickle
 
+try:
+    import numpy as np
+except ImportError:
+    np = None          # NumPy is optional, only needed for the batch methods
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import time as clock
+
+
+
+# Result for geopositions which are not located in any state
+NO_STATE = None
+
 
 
 """
@@ -21,10 +43,54 @@ Instantiate the class by specifying the pickle-serialized file with the polygon
 data for the states. See state_borders_generation.py file for details on the
 format of this data structure.
 
+Instead of the pickle file, the binary file written by the generator (states-US.bin)
+can be used. It is memory-mapped instead of being read, so the constructor returns
+immediately and all processes using the file share its memory, see state_borders_format.py.
+
 Most interesting method is
     state_of_geoposition(lat, long)
 which returns a string with the abbreviation (e.g. PA) of the state where the
-geoposition is located in.
+geoposition is located in, or NO_STATE (None) if it is not located in any state.
+
+On the first query a grid index (cells of grid_cell_size degrees, default 0.25) is built.
+Geopositions in cells without any state border are answered directly, only cells
+crossed by a border need the polygon test. Pass grid_cell_size=None to disable it.
+Border cells are divided again (coverage_subdivision, default 8) into sub-cells, and
+geopositions in sub-cells which are entirely outside of all states (ocean, Canada,
+Mexico) are rejected without any polygon test.
+
+With raster_file, a precomputed raster (see state_raster_generator.py) answers all
+geopositions in its cells which are entirely inside one state or outside of all states,
+before the grid index. Only geopositions in its border cells get to the grid index and the
+polygon tests. raster_info() returns how many queries the raster answered (hit ratio).
+
+Repeated queries can be cached: with cache_size > 0 the results of up to cache_size
+geopositions and geohash cells (cache_precision characters) are kept, evicted in
+cache_policy order ('lru' or 'fifo'). Cells are only cached if they are provably
+entirely inside one state. cache_info() returns the hit/miss counters.
+
+Why a query is slow can be seen with enable_stats(callback): from then on, every
+state_of_geoposition records the states rejected by the bounding box test, the polygons
+(rings) tested, the edges visited, the time of the winding number tests and which index
+or cache answered it. stats_info() returns the totals, callback (if given) gets the
+numbers of each query. As long as the stats are not enabled, nothing is recorded at all.
+
+If the binary file has child layers (e.g. counties and ZCTAs, see state_borders_generator.py),
+    lookup(lat, long)
+returns a dict with the state and the feature of each layer, e.g.
+{'state': 'PA', 'county': '42101', 'zcta': '19103'}. Each layer only tests the children of
+the feature found in the layer above. The layers are in self.layers as (name,
+state_determination of the layer, children).
+
+For sequential geopositions (GPS tracks) there is
+    tester.track().state_of_geoposition(lat, long)
+which answers geopositions close to the previous one without any test, see state_track below.
+
+For many geopositions at once there is
+    state_of_geopositions(lats, longs)
+which takes NumPy arrays and returns a NumPy array of state abbreviations
+(None where a geoposition is not located in any state). NumPy is only needed
+for this batch method.
 
 
 
@@ -40,6 +106,18 @@ Line      - Python namedtuple of two geopoints, i.e.
 
 Polygon - Python list of Geopoints, i.e. [ Geopoint, Geopoint, Geopoint, ..., Geopoint ]
 
+EdgeTable - Python namedtuple of packed arrays with the edges of a closed polygon (or of all
+            rings of a state), edge j goes from vertex j to vertex j+1, see edge_table():
+              lats, longs               - the vertices
+              delta_lats, delta_longs   - lats[j+1] - lats[j], longs[j+1] - longs[j]
+              min_lats, max_lats        - the latitude range of edge j
+
+In memory, the polygons of a state are not kept as lists but in a compact form:
+one array('d') with the latitudes and one with the longitudes of all vertices, plus
+an array with the offsets of the single polygons (rings), see state_borders_format.py.
+If the data file contains simplified polygons, they are used for geopositions which are
+not near the border, see wn_point_simplified().
+
 
 """
 class state_determination:
@@ -47,17 +125,83 @@ class state_determination:
 
 
 
-    def __init__(self, state_file):
+    def __init__(self, state_file, grid_cell_size=0.25, cache_size=0, cache_policy='lru', cache_precision=7,
+                 coverage_subdivision=8, raster_file=None, edge_bin_size=0.1):
+
+        # Child layers (e.g. county, zcta), see lookup()
+        self.layers = []
+
+        if isinstance(state_file, dict):
+            self.states = state_file                    # already in compact form (a child layer)
+        else:
+            print("Reading states border data from {0} ... ".format(state_file), end="")
+            sys.stdout.flush()  # Py 2 seems to flush stdout automatically, Py 3 not
+            if is_binary_borders(state_file):
+                self.states, layers = read_borders(state_file, with_layers=True)     # memory-mapped, returns immediately
+                self.layers = [(name, state_determination(features, grid_cell_size=None), children)
+                               for name, features, children in layers]
+            else:
+                with open(state_file, "rb") as file:
+                    self.states = compact_states(cPickle.load(file))
+            print("Done.\n")
 
-        print("Reading states border data from {0} ... ".format(state_file), end="")
-        sys.stdout.flush()  # Py 2 seems to flush stdout automatically, Py 3 not
-        with open(state_file, "rb") as file:
-            self.states = cPickle.load(file)
-        print("Done.\n")
+        # The rings of each state in the order they are tested: largest area first
+        self._ring_order = dict((state_abbrev, ring_order(state_data['ring_info']))
+                                for state_abbrev, state_data in self.states.items())
 
         # Type definitions, see description above for more details
         self.Geopoint = namedtuple('Geopoint', ['lat', 'long'])
         self.Line = namedtuple('Line', ['p1', 'p2'])
+        self.EdgeTable = namedtuple('EdgeTable', ['lats', 'longs', 'delta_lats', 'delta_longs', 'min_lats', 'max_lats'])
+
+        self.NearestBorder = namedtuple('NearestBorder', ['state', 'distance', 'segment'])
+
+        # Edge tables of the states, see _state_edges()
+        self._edge_tables = dict()
+
+        # Edge index (bins of edge_bin_size degrees), see _build_edge_index(). Built on first use.
+        self._edge_bins = None
+        self._edge_bin_size = edge_bin_size
+
+        # NumPy version of the polygons, see _np_polygons()
+        self._np_states = None
+
+        # Latitude slabs of the rings, see _ring_slabs()
+        self._slabs = dict()
+
+        # Spatial index (uniform grid of grid_cell_size degrees), see _build_grid_index().
+        # Built on the first query, so that the constructor returns quickly.
+        self._grid = None
+        self._grid_size = grid_cell_size
+
+        # Coverage mask of the border cells, see _build_coverage_mask()
+        self._coverage = None
+        self._coverage_subdivision = coverage_subdivision
+
+        # Optional precomputed raster, see _raster_value()
+        self._raster = None
+        self._raster_hits = self._raster_border_hits = 0
+        self._np_raster = None          # NumPy version, see _np_raster_values()
+        if raster_file is not None:
+            self._raster = read_raster(raster_file)
+            unknown = [state_abbrev for state_abbrev in self._raster['states'] if state_abbrev not in self.states]
+            if unknown:
+                raise ValueError("{0} has states which are not in {1}: {2}".format(raster_file, state_file,
+                                                                                ", ".join(unknown)))
+
+        # Optional statistics, see enable_stats()
+        self._stats = None
+
+        # Optional result cache, see _cached_state()
+        if cache_policy not in ('lru', 'fifo'):
+            raise ValueError("cache_policy must be 'lru' or 'fifo'")
+        self._cache = OrderedDict() if cache_size > 0 else None
+        self._cache_size = cache_size
+        self._cache_lru = cache_policy == 'lru'
+        self._cache_lat_bits = 5 * cache_precision // 2             # bits of a geohash with
+        self._cache_long_bits = 5 * cache_precision - self._cache_lat_bits    # cache_precision characters
+        self._cache_hits = self._cache_cell_hits = self._cache_misses = 0
+        self._border_rings = None           # see _build_border_rings()
 
 
     #
@@ -75,8 +219,55 @@ class state_determination:
     #
     def is_left(self, geop, line):
 
-        return ( (line.p2.long - line.p1.long) * (geop.lat - line.p1.lat)
-                -  (geop.long - line.p1.long) * (line.p2.lat - line.p1.lat) )
+        (start_lat, start_long), (end_lat, end_long) = line
+        return ( (end_long - start_long) * (geop[0] - start_lat)
+                -  (geop[1] - start_long) * (end_lat - start_lat) )
+
+
+
+
+    #
+    # Same as is_left, for edge j of an edge table (the line from vertex j to vertex j+1):
+    # the differences of the coordinates are taken from the table instead of being computed.
+    #
+    def is_left_edge(self, geop, table, j):
+
+        return ( table.delta_longs[j] * (geop[0] - table.lats[j])
+                -  (geop[1] - table.longs[j]) * table.delta_lats[j] )
+
+
+
+
+    #
+    # Precomputes the edge table (see above) of the vertices lats, longs.
+    # For the compact storage of a state, the "edges" from the last vertex of a ring
+    # to the first vertex of the next ring are in the table as well, but never used.
+    #
+    def edge_table(self, lats, longs):
+
+        lats_from, lats_to = lats[:-1], lats[1:]
+        return self.EdgeTable(lats, longs,
+                              array('d', map(operator.sub, lats_to, lats_from)),
+                              array('d', map(operator.sub, longs[1:], longs[:-1])),
+                              array('d', map(min, lats_to, lats_from)),
+                              array('d', map(max, lats_to, lats_from)))
+
+
+
+
+    #
+    # The edge table of all rings of a state (or of its simplified rings), built on first use
+    #
+    def _state_edges(self, state_abbrev, simplified=False):
+
+        key = (state_abbrev, simplified)
+        table = self._edge_tables.get(key)
+        if table is None:
+            state_data = self.states[state_abbrev]
+            if simplified:
+                state_data = state_data['simplified']
+            table = self._edge_tables[key] = self.edge_table(state_data['lats'], state_data['longs'])
+        return table
 
 
 
@@ -87,95 +278,1889 @@ class state_determination:
     #
     #     Input:  geop     - Geopoint(lat, long)
     #             polygon  - List of Geopoints: [ Geopoint(lat, long), Geopoint(lat, long), ..., Geopoint(lat, long) ]
+    #                        or its EdgeTable (polygon closed by its last vertex in front, see edge_table)
     #     Return: wn       - the winding number (=0 if point is outside polygon)
     #
     def wn_point_polygon(self, geop, polygon):
 
-        wn = 0      # winding number counter
+        if not isinstance(polygon, self.EdgeTable):
+            polygon = list(polygon)
+            polygon = self.edge_table(array('d', [point[0] for point in polygon[-1:] + polygon]),
+                                      array('d', [point[1] for point in polygon[-1:] + polygon]))
 
-        # loop through all edges of the polygon
-        for i in range(len(polygon)):
+        return self._wn_edges(geop[0], geop[1], polygon, range(len(polygon.delta_lats)))
 
-            # Make sure that we have the two points of the edge as Geopoint type
-            if not isinstance(polygon[i-1], self.Geopoint):
-                start = self.Geopoint._make(polygon[i-1])
-            else:
-                start = polygon[i-1]
 
-            if not isinstance(polygon[i], self.Geopoint):
-                end = self.Geopoint._make(polygon[i])
+
+
+    #
+    # Winding number (wn) test for a point in a ring of the compact polygon storage
+    # Same as wn_point_polygon, but the polygon is given as the vertices
+    # start to stop of a closed ring (first vertex = last vertex) in an edge table
+    # (e.g. of all rings of a state), i.e. edge j goes from vertex j to vertex j+1.
+    #
+    #     Input:  geop         - Geopoint(lat, long)
+    #             table        - edge table with the vertices of all rings of a state
+    #             start, stop  - the vertices of the ring
+    #     Return: wn           - the winding number (=0 if point is outside polygon)
+    #
+    def wn_point_ring(self, geop, table, start, stop):
+
+        return self._wn_edges(geop[0], geop[1], table, range(start, stop - 1))
+
+
+
+
+    #
+    # Winding number (wn) counter over the given edges of an edge table,
+    # edge j goes from vertex j to vertex j+1.
+    #
+    # An edge with start y <= P.y < end y is an upward crossing, one with end y <= P.y < start y
+    # a downward crossing: in both cases P.y is in the half-open latitude range of the edge,
+    # and the sign of delta_lats tells which one it is. All other edges are skipped.
+    #
+    def _wn_edges(self, lat, long, table, edges):
+
+        lats, longs, delta_lats, delta_longs, min_lats, max_lats = table
+
+        wn = 0
+        for j in edges:
+            if min_lats[j] <= lat < max_lats[j]:
+                left = delta_longs[j] * (lat - lats[j]) - (long - longs[j]) * delta_lats[j]    # is_left_edge
+
+                if delta_lats[j] > 0:                               # an upward crossing
+                    if left > 0:                                    # P is left of edge
+                        wn += 1
+
+                elif left < 0:                                      # a downward crossing, P is right of edge
+                    wn -= 1
+
+        return wn
+
+
+
+
+    #
+    # Splits the latitude range of a ring into bands (slabs) of equal height
+    # and lists for each band the edges whose latitude range overlaps the band.
+    # Edge j goes from vertex j to vertex j+1, like in wn_point_ring.
+    # (Horizontal edges are listed as well: they never cross, but the slabs are also
+    # used to find all edges near a geoposition.)
+    #
+    #     Input:  lats         - array with the latitudes of all rings of a state
+    #             start, stop  - the vertices of the ring
+    #             margin       - edges are also listed in the bands up to margin away
+    #     Return: slabs        - (south, north, band height, [ array of edge indexes, ... ])
+    #
+    def build_slabs(self, lats, start, stop, edges_per_band=8, margin=0.0):
+
+        if stop - start < 2:                        # no edges at all
+            return (1.0, 0.0, 1.0, [array('l')])
+
+        south, north = min(lats[start:stop]), max(lats[start:stop])
+        count = max(1, (stop - start) // edges_per_band)
+        height = (north - south) / count or 1.0     # or: ring without any height
+        bands = [[] for _ in range(count)]
+
+        for j in range(start, stop - 1):
+            lo = self._slab_band(min(lats[j], lats[j+1]) - margin, south, height, count)
+            hi = self._slab_band(max(lats[j], lats[j+1]) + margin, south, height, count)
+            for band in range(lo, hi + 1):
+                bands[band].append(j)
+
+        return (south, north, height, [array('l', band) for band in bands])
+
+
+
+
+    #
+    # Band of a latitude in the slabs, clamped to the existing bands
+    #
+    def _slab_band(self, lat, south, height, count):
+
+        return min(max(int(math.floor((lat - south) / height)), 0), count - 1)
+
+
+
+
+    #
+    # The slabs of ring number ring_index of a state (or of its simplified ring), built on first use
+    #
+    def _ring_slabs(self, state_abbrev, ring_index, simplified=False):
+
+        key = (state_abbrev, ring_index, simplified)
+        slabs = self._slabs.get(key)
+        if slabs is None:
+            state_data = self.states[state_abbrev]
+            margin = 0.0
+            if simplified:
+                state_data = state_data['simplified']
+                margin = self._tolerance_band(state_data)
+            rings = state_data['rings']
+            slabs = self._slabs[key] = self.build_slabs(state_data['lats'], rings[ring_index], rings[ring_index + 1],
+                                                        margin=margin)
+        return slabs
+
+
+
+
+    #
+    # Winding number (wn) test for a point in a ring, using the slabs of the ring
+    # Gives exactly the same result as wn_point_ring, but only the edges of the band
+    # containing the point are tested: all other edges cannot cross the point's latitude.
+    #
+    #     Input:  geop         - Geopoint(lat, long)
+    #             table        - edge table with the vertices of all rings of a state
+    #             slabs        - the slabs of the ring, see build_slabs()
+    #     Return: wn           - the winding number (=0 if point is outside polygon)
+    #
+    def wn_point_slabs(self, geop, table, slabs):
+
+        south, north, height, bands = slabs
+        lat, long = geop[0], geop[1]
+
+        if not south <= lat <= north:               # (also catches NaN)
+            return 0
+
+        return self._wn_edges(lat, long, table, bands[self._slab_band(lat, south, height, len(bands))])
+
+
+
+
+    #
+    # Polygons stored as arcs (see state_borders_format.build_topology)
+    #
+    # The common border of two states is one arc in the rings of both, once forward and
+    # once backward. The winding number test on the arcs computes is_left for each edge of
+    # the arc in the direction it is stored in, and negates the crossing for a reversed arc.
+    # So a geoposition near (or exactly on) a common border gets exactly opposite crossings
+    # from the two states, and the sum of their winding numbers is always the winding number
+    # of both states together: the geoposition is in exactly one of them, never in both or
+    # in neither, even where the rounding of is_left decides. (The rings of each state as
+    # vertices can differ in the last bit, because the edges of the two rings go in opposite
+    # directions.)
+    #
+
+    #
+    # The vertices of ring number ring_index of a state in pieces, without putting a ring
+    # stored as arcs together: (lats, longs, start, stop, backward) for each piece, i.e. the
+    # edges from vertex j to vertex j+1 of lats, longs for j in range(start, stop - 1), and
+    # backward if the ring runs through them from vertex j+1 to vertex j (a reversed arc).
+    # A ring which is not stored as arcs is one piece.
+    #
+    def _ring_pieces(self, state_abbrev, ring_index):
+
+        state_data = self.states[state_abbrev]
+        topology = state_data.get('topology')
+        if topology is None:
+            rings = state_data['rings']
+            return [(state_data['lats'], state_data['longs'], rings[ring_index], rings[ring_index + 1], False)]
+
+        arcs, refs, rings = topology['arcs'], topology['refs'], topology['rings']
+        offsets = arcs['offsets']
+        pieces = []
+        for i in range(rings[ring_index], rings[ring_index + 1]):
+            arc = refs[i] if refs[i] >= 0 else ~refs[i]
+            pieces.append((arcs['lats'], arcs['longs'], offsets[arc], offsets[arc+1], refs[i] < 0))
+        return pieces
+
+
+
+
+    #
+    # The slabs (see build_slabs) of ring number ring_index of a state stored as arcs, built on
+    # first use. The bands list the edges of the arcs, edge j from vertex j to vertex j+1 of the
+    # vertices of all arcs, ~j for edge j of a reversed arc.
+    #
+    def _arc_slabs(self, state_abbrev, ring_index, edges_per_band=8):
+
+        key = (state_abbrev, ring_index, 'arcs')
+        slabs = self._slabs.get(key)
+        if slabs is None:
+            lats = self.states[state_abbrev]['topology']['arcs']['lats']
+
+            edges = array('l')
+            for _, _, start, stop, backward in self._ring_pieces(state_abbrev, ring_index):
+                if backward:
+                    edges.extend(~j for j in range(start, stop - 1))
+                else:
+                    edges.extend(range(start, stop - 1))
+
+            if not edges:                           # no edges at all
+                slabs = (1.0, 0.0, 1.0, [array('l')])
             else:
-                end = polygon[i]
+                info = self.states[state_abbrev]['ring_info']
+                south, north = info[5 * ring_index], info[5 * ring_index + 1]
+                count = max(1, len(edges) // edges_per_band)
+                height = (north - south) / count or 1.0
+                bands = [array('l') for _ in range(count)]
+                for e in edges:
+                    j = e if e >= 0 else ~e
+                    for band in range(self._slab_band(min(lats[j], lats[j+1]), south, height, count),
+                                      self._slab_band(max(lats[j], lats[j+1]), south, height, count) + 1):
+                        bands[band].append(e)
+                slabs = (south, north, height, bands)
+
+            self._slabs[key] = slabs
+        return slabs
+
 
 
-            if start.lat <= geop.lat:                               # make sure that start y <= P.y
-                if end.lat > geop.lat:                              # an upward crossing
-                    if self.is_left( geop, self.Line(start, end) ) > 0:       # P is left of edge
-                        wn += 1                                     # a valid up intersection
 
-            else:                                                   # start y > P.y (no test needed)
-                if end.lat <= geop.lat:                             # a downward crossing
-                    if self.is_left( geop, self.Line(start, end) ) < 0:       # P is right of edge
-                        wn -= 1                                     # a valid down intersection
+    #
+    # Winding number (wn) test for a point in a ring stored as arcs, using the slabs of the ring
+    # Same as wn_point_slabs, but directly on the vertices of the arcs (on the mapped file):
+    # the differences are computed exactly like in edge_table, so no edge table is needed.
+    #
+    #     Input:  geop         - Geopoint(lat, long)
+    #             arcs         - the arcs, see state_borders_format.build_topology()
+    #             slabs        - the slabs of the ring, see _arc_slabs()
+    #     Return: wn           - the winding number (=0 if point is outside polygon)
+    #
+    def wn_point_arcs(self, geop, arcs, slabs):
+
+        south, north, height, bands = slabs
+        lat, long = geop[0], geop[1]
+
+        if not south <= lat <= north:               # (also catches NaN)
+            return 0
+
+        lats, longs = arcs['lats'], arcs['longs']
+
+        wn = 0
+        for e in bands[self._slab_band(lat, south, height, len(bands))]:
+            j = e if e >= 0 else ~e
+            start_lat, end_lat = lats[j], lats[j+1]
+
+            # Same rules as _wn_edges, for the arc in its stored direction
+            if start_lat <= lat < end_lat:                  # an upward crossing
+                if ((longs[j+1] - longs[j]) * (lat - start_lat) - (long - longs[j]) * (end_lat - start_lat)) <= 0:
+                    continue
+                crossing = 1
+            elif end_lat <= lat < start_lat:                # a downward crossing
+                if ((longs[j+1] - longs[j]) * (lat - start_lat) - (long - longs[j]) * (end_lat - start_lat)) >= 0:
+                    continue
+                crossing = -1
+            else:
+                continue
 
+            wn += crossing if e >= 0 else -crossing
 
         return wn
 
 
 
 
+    #
+    # The winding number of the exact ring number ring_index of a state: on the arcs if the
+    # state is stored as arcs, otherwise with wn_point_slabs
+    #
+    def _wn_point_exact(self, geop, state_abbrev, ring_index):
+
+        topology = self.states[state_abbrev].get('topology')
+        if topology is not None:
+            return self.wn_point_arcs(geop, topology['arcs'], self._arc_slabs(state_abbrev, ring_index))
+        return self.wn_point_slabs(geop, self._state_edges(state_abbrev), self._ring_slabs(state_abbrev, ring_index))
+
+
+
+
+    #
+    # Winding number (wn) test for a point in ring number ring_index of a state, using the
+    # simplified ring where possible.
+    #
+    # Every point of the exact ring is at most tolerance away from the simplified ring
+    # (see state_borders_generator.simplify_ring). So if the point is farther than tolerance
+    # away from all edges of the simplified ring, the exact ring can be deformed into the
+    # simplified one without ever passing over the point, and both have the same winding
+    # number around it. Only points near the border need the exact ring.
+    #
+    # The slabs of the simplified ring list each edge in all bands within tolerance of
+    # the edge, so one band has all edges for both the crossings and the distance test.
+    #
+    #     Input:  geop         - Geopoint(lat, long)
+    #     Return: wn           - the winding number (=0 if point is outside polygon)
+    #
+    def wn_point_simplified(self, geop, state_abbrev, ring_index):
+
+        state_data = self.states[state_abbrev]
+        band = self._tolerance_band(state_data['simplified'])
+        lat, long = geop[0], geop[1]
+
+        south, north, height, bands = self._ring_slabs(state_abbrev, ring_index, True)
+        if not south - band <= lat <= north + band:     # (also catches NaN)
+            return 0
+
+        table = self._state_edges(state_abbrev, True)
+        edges = bands[self._slab_band(lat, south, height, len(bands))]
+
+        if self._nearest_of_edges(lat, long, table, edges, band)[1] is not None:
+            return self._wn_point_exact(geop, state_abbrev, ring_index)     # near the border: exact test
+        return self._wn_edges(lat, long, table, edges)
+
+
+
+
+    #
+    # The tolerance of simplified polygons, slightly enlarged for the rounding errors of the distances
+    #
+    def _tolerance_band(self, simplified):
+
+        return simplified['tolerance'] * (1 + 1e-6) + 1e-7
+
+
+
+
+    #
+    # Squared distance of the point (lat, long) to the segment from (lat1, long1)
+    # to (lat2, long2), lat and long taken as plane coordinates (in degrees)
+    #
+    def segment_distance2(self, lat, long, lat1, long1, lat2, long2):
+
+        delta_lat, delta_long = lat2 - lat1, long2 - long1
+        length2 = delta_lat * delta_lat + delta_long * delta_long
+        t = 0.0
+        if length2 > 0.0:
+            t = min(1.0, max(0.0, ((lat - lat1) * delta_lat + (long - long1) * delta_long) / length2))
+        lat_diff = lat1 + t * delta_lat - lat
+        long_diff = long1 + t * delta_long - long
+        return lat_diff * lat_diff + long_diff * long_diff
+
+
+
+
+    #
+    # The nearest of some edges of a state (see edge_table) which is at most distance away from
+    # the geoposition. The distance is only computed within the bounding box of an edge plus
+    # the distance found so far. All longitudes are multiplied by long_scale: 1.0 takes lat and
+    # long as plane coordinates (like the tolerance of the simplified polygons), cos(lat) gives
+    # distances on the ground in degrees of latitude (see _nearest_edge).
+    #
+    #     Input:  table       - the edge table of the state
+    #             edges       - iterable of the edges j (from vertex j to vertex j+1) to look at
+    #             distance    - the largest distance of interest
+    #     Return: (distance2, j) - squared distance and index of the nearest edge (the first one
+    #                              of equally near edges), or (distance ** 2, None) if there is none
+    #
+    def _nearest_of_edges(self, lat, long, table, edges, distance, long_scale=1.0):
+
+        lats, longs, _, _, min_lats, max_lats = table
+
+        best2, best = distance * distance, None
+        long_distance = distance / long_scale
+        for j in edges:
+            if (min_lats[j] - distance <= lat <= max_lats[j] + distance
+                    and (long + long_distance >= longs[j] or long + long_distance >= longs[j+1])
+                    and (long - long_distance <= longs[j] or long - long_distance <= longs[j+1])):
+                distance2 = self.segment_distance2(lat, long * long_scale, lats[j], longs[j] * long_scale,
+                                                   lats[j+1], longs[j+1] * long_scale)
+                if distance2 < best2 or (distance2 == best2 and best is None):
+                    best2, best = distance2, j
+                    distance = math.sqrt(best2)
+                    long_distance = distance / long_scale
+
+        return best2, best
+
+
+
+
+    #
+    # Lower bound of the distance (in degrees, lat and long taken as plane coordinates) from
+    # the geoposition to the nearest edge of any ring of any state, capped at radius.
+    # Only the rings whose bounding box is within radius, and of those only the edges in
+    # the slabs within radius of the latitude, are looked at. Rings with a simplified ring
+    # use that one while the geoposition is well outside of its tolerance band (the exact
+    # ring is at most the tolerance farther away).
+    #
+    #     Input:  lat, long  - the geoposition
+    #             radius     - the largest distance of interest
+    #     Return: distance   - 0 <= distance <= radius, no edge is closer than distance
+    #
+    def border_distance_bound(self, lat, long, radius):
+
+        distance = radius
+        for state_abbrev, state_data in self.states.items():
+            info = state_data['ring_info']
+            simplified = 'simplified' in state_data
+            band = self._tolerance_band(state_data['simplified']) if simplified else 0.0
+
+            for ring_index in range(len(info) // 5):
+                if (lat < info[5 * ring_index] - distance or lat > info[5 * ring_index + 1] + distance
+                        or long < info[5 * ring_index + 2] - distance or long > info[5 * ring_index + 3] + distance):
+                    continue
+
+                ring_distance = None
+                if simplified:
+                    ring_distance = self._ring_distance(lat, long, state_abbrev, ring_index, True, distance + band) - band
+                    if ring_distance < band:        # near the border: measure the exact ring
+                        ring_distance = None
+                if ring_distance is None:
+                    ring_distance = self._ring_distance(lat, long, state_abbrev, ring_index, False, distance)
+                distance = min(distance, ring_distance)
+
+        return max(distance, 0.0)
+
+
+
+
+    #
+    # Distance from the geoposition to the nearest edge of a ring, capped at radius
+    # (the edges in the slabs within radius of the latitude)
+    #
+    def _ring_distance(self, lat, long, state_abbrev, ring_index, simplified, radius):
+
+        south, north, height, bands = self._ring_slabs(state_abbrev, ring_index, simplified)
+        table = self._state_edges(state_abbrev, simplified)
+
+        distance = radius
+        for band in range(self._slab_band(lat - radius, south, height, len(bands)),
+                          self._slab_band(lat + radius, south, height, len(bands)) + 1):
+            distance2, j = self._nearest_of_edges(lat, long, table, bands[band], distance)
+            if j is not None:
+                distance = math.sqrt(distance2)
+
+        return distance
+
+
+
+
+    #
+    # Nearest state: the state the geoposition is located in (distance 0), or else the state
+    # with the nearest border, e.g. for geopositions just off the coast.
+    # Distances are on the ground, in degrees of latitude (see _nearest_edge).
+    #
+    #     Input:  lat, long      - the geoposition
+    #             max_distance   - only states up to this distance (None: any distance)
+    #     Return: NearestBorder(state, distance, segment) - segment is the Line of the nearest
+    #             border (None for a geoposition inside a state), or None if there is no such state
+    #
+    def nearest_state(self, lat, long, max_distance=None):
+
+        state = self.state_of_geoposition(lat, long)
+        if state is not NO_STATE:
+            return self.NearestBorder(state, 0.0, None)
+        return self._nearest_edge(lat, long, None, max_distance)
+
+
+
+
+    #
+    # Distance to the nearest border: of the state the geoposition is located in,
+    # or of any state for a geoposition outside of all states.
+    # Distances are on the ground, in degrees of latitude (see _nearest_edge).
+    #
+    #     Input:  lat, long      - the geoposition
+    #             max_distance   - only borders up to this distance (None: any distance)
+    #     Return: NearestBorder(state, distance, segment) - state is the state of the border,
+    #             segment its nearest edge as Line, or None if there is no such border
+    #
+    def distance_to_border(self, lat, long, max_distance=None):
+
+        return self._nearest_edge(lat, long, self.state_of_geoposition(lat, long), max_distance)
+
+
+
+
+    #
+    # The nearest edge (of the rings of one state, or of all states if state_abbrev is None),
+    # found with the edge index: the rows of bins are searched from the row of the geoposition
+    # outwards, and in each row the bins from the column of the geoposition outwards, as long
+    # as the bins can contain an edge nearer than the nearest one found so far.
+    #
+    # Distances are on the ground, in degrees of latitude (about 111 km): the longitudes are
+    # multiplied by the cosine of the latitude of the geoposition, so that the nearest edge is
+    # also the nearest one far north (Alaska) and not the nearest in degrees of longitude.
+    #
+    def _nearest_edge(self, lat, long, state_abbrev, max_distance):
+
+        if self._edge_bins is None:
+            self._build_edge_index(self._edge_bin_size)
+        lat0, long0, size, rows, bins, row_cols = self._edge_bins
+        states = self._edge_bin_states
+
+        try:
+            row, col = int(math.floor((lat - lat0) / size)), int(math.floor((long - long0) / size))
+        except (ValueError, OverflowError):
+            return None                 # NaN or infinite coordinates
+        long_scale = max(math.cos(math.radians(lat)), 1e-9)       # (not 0 at the poles)
+
+        state_index = states.index(state_abbrev) if state_abbrev is not None else None
+        distance = max_distance if max_distance is not None else float('inf')
+        best2 = distance * distance
+        best = None
+
+        # (the rows before the first row of the index have no bins anyway)
+        step = max(0, -row, row - rows + 1)
+        while step <= max(row, rows - 1 - row):
+            searched = False
+            for bin_row in ((row,) if step == 0 else (row - step, row + step)):
+                # Distance of the row of bins in latitude
+                lat_gap = max(lat0 + bin_row * size - lat, lat - (lat0 + (bin_row + 1) * size), 0.0)
+                if lat_gap * lat_gap > best2:
+                    continue
+                searched = True
+                cols = row_cols.get(bin_row, ())
+
+                # The bins east of the geoposition (and its own), then the bins west of it,
+                # until the next bin is too far away
+                first = bisect_right(cols, col - 1)
+                for indexes in (range(first, len(cols)), range(first - 1, -1, -1)):
+                    for i in indexes:
+                        long_gap = max(long0 + cols[i] * size - long, long - (long0 + (cols[i] + 1) * size), 0.0)
+                        long_gap *= long_scale
+                        if lat_gap * lat_gap + long_gap * long_gap > best2:
+                            break
+
+                        for index, edges in bins[(bin_row, cols[i])]:
+                            if state_index is not None and index != state_index:
+                                continue
+                            distance2, j = self._nearest_of_edges(lat, long, self._state_edges(states[index]), edges,
+                                                                  distance, long_scale)
+                            if j is not None and (distance2 < best2 or best is None):
+                                best2, best = distance2, (index, j)
+                                distance = math.sqrt(best2)
+
+            if not searched and step > 0:
+                break                   # both rows are too far away, so are all further rows
+            step += 1
+
+        if best is None:
+            return None
+        index, j = best
+        lats, longs = self._state_edges(states[index])[:2]
+        return self.NearestBorder(states[index], math.sqrt(best2),
+                                  self.Line(self.Geopoint(lats[j], longs[j]), self.Geopoint(lats[j+1], longs[j+1])))
+
+
+
+
+    #
+    # Edge index
+    #
+    # The area covered by the bounding boxes of all rings is divided into square bins of
+    # bin_size degrees, and each edge of each ring is listed in all bins it runs through
+    # (see _edge_cells).
+    #
+    # self._edge_bins is (lat0, long0, bin_size, rows, bins, row_cols): bins maps (row, col) of
+    # a bin to the edges in it, as list of (position of the state in self._edge_bin_states, array
+    # of the edges j of the state) (bins without edges are not in the dict), row_cols maps each
+    # row to the sorted columns of its bins.
+    #
+    def _build_edge_index(self, bin_size):
+
+        self._edge_bin_states = states = list(self.states)
+        lat0 = min(min(self.states[state_abbrev]['ring_info'][0::5] or [90.0]) for state_abbrev in states)
+        long0 = min(min(self.states[state_abbrev]['ring_info'][2::5] or [180.0]) for state_abbrev in states)
+        north = max(max(self.states[state_abbrev]['ring_info'][1::5] or [-90.0]) for state_abbrev in states)
+        rows = int(math.floor((north - lat0) / bin_size)) + 1
+
+        bins = dict()
+        margin = 1e-9 * bin_size          # (so that rounding never puts an edge into a wrong bin)
+        for index, state_abbrev in enumerate(states):
+            state_data = self.states[state_abbrev]
+            lats, longs, rings = state_data['lats'], state_data['longs'], state_data['rings']
+            for ring_index in range(len(rings) - 1):
+                for j in range(rings[ring_index], rings[ring_index + 1] - 1):
+                    for row, first_col, last_col in self._edge_cells(lats[j], longs[j], lats[j+1], longs[j+1],
+                                                                     lat0, long0, bin_size, margin):
+                        for col in range(first_col, last_col + 1):
+                            edges = bins.setdefault((row, col), [])
+                            if not edges or edges[-1][0] != index:
+                                edges.append((index, array('l')))
+                            edges[-1][1].append(j)
+
+        # The columns of the bins with edges, per row (sorted, for the search in _nearest_edge)
+        row_cols = dict()
+        for row, col in bins:
+            row_cols.setdefault(row, []).append(col)
+        row_cols = dict((row, array('l', sorted(cols))) for row, cols in row_cols.items())
+
+        self._edge_bins = (lat0, long0, bin_size, rows, bins, row_cols)
+
+
+
+
+    #
+    # Starts a track: a state_track for sequential geopositions (e.g. a GPS track)
+    # which remembers the last state, see state_track below
+    #
+    def track(self, radius=0.05):
+
+        return state_track(self, radius)
+
+
+
+
     #
     # Returns the abbreviation of the state (e.g. PA) where the geoposition
     # (specified by lat and long) is located in.
     #
     def state_of_geoposition(self, lat, long):
 
+        # Raster: cells which are not border cells are answered directly
+        if self._raster is not None:
+            value = self._raster_value(lat, long)
+            if value != RASTER_BORDER:
+                self._raster_hits += 1
+                return self._raster['states'][value - 1] if value else NO_STATE
+            self._raster_border_hits += 1
+
         geopos = self.Geopoint(lat, long)
 
-        for state_abbrev, state_data in self.states.items():
+        # Grid index: cells without any border in it are answered directly,
+        # for border cells only the states of that cell have to be tested.
+        candidates = self.states
+        if self._grid is None and self._grid_size is not None:
+            self.build_index()
+        if self._grid is not None:
+            row_col = self._grid_cell(lat, long)
+            cell = self._grid.get(row_col)
+            if cell is None:                        # outside of all states
+                return NO_STATE
+            if not isinstance(cell, tuple):         # entirely inside one state
+                return cell
+            if self._coverage is not None and self._is_uncovered(lat, long, row_col):
+                return NO_STATE
+            candidates = cell
+
+        if self._cache is not None:
+            return self._cached_state(geopos, candidates)
+
+        return self._state_of_candidates(geopos, candidates)
+
+
+
+
+    #
+    # Hierarchical lookup: the state, and in each child layer (e.g. county and zcta) the
+    # feature the geoposition is located in. Each layer only tests the children of the
+    # feature found in the layer above (see state_borders_generator.assign_children).
+    #
+    #     Return: dict 'state' -> abbreviation, and layer name -> key of the feature
+    #             (NO_STATE where the geoposition is not located in any)
+    #
+    def lookup(self, lat, long):
+
+        parent = self.state_of_geoposition(lat, long)
+        result = {'state': parent}
+
+        for name, layer, children in self.layers:
+            if parent is not NO_STATE:
+                parent = layer._state_of_candidates(layer.Geopoint(lat, long), children.get(parent, ()))
+            result[name] = parent
+
+        return result
+
+
+
+
+    #
+    # The actual state determination: the first of the candidate states
+    # (by default all states) which contains the geoposition
+    #
+    def _state_of_candidates(self, geopos, candidates):
+
+        for state_abbrev in candidates:
+            state_data = self.states[state_abbrev]
 
             # Bounding box test:
             # If the point is outside the rectangle defined by the
             # northernmost, easternmost, southernmost and westernmost point of the state,
             # then we can skip the current state, i.e. continue with next loop iteration
             #
-            if (geopos.lat > state_data['rectangle']['N']
-                    or geopos.lat < state_data['rectangle']['S']
-                    or geopos.long > state_data['rectangle']['E']
-                    or geopos.long < state_data['rectangle']['W']):
+            if not self.in_rectangle(state_data['rectangle'], geopos.lat, geopos.long):
                 continue
 
-            poly_count = 0
-            for poly in state_data['polygons']:
-                poly_count += 1
-                if self.wn_point_polygon(geopos, poly) != 0:
+            # The rings in order of area (the largest ring is the most likely hit),
+            # skipping those whose bounding box does not contain the point
+            info = state_data['ring_info']
+            simplified = 'simplified' in state_data
+            for ring_index in self._ring_order[state_abbrev]:
+                if (geopos.lat < info[5 * ring_index] or geopos.lat > info[5 * ring_index + 1]
+                        or geopos.long < info[5 * ring_index + 2] or geopos.long > info[5 * ring_index + 3]):
+                    continue
+                if simplified:
+                    wn = self.wn_point_simplified(geopos, state_abbrev, ring_index)
+                else:
+                    wn = self._wn_point_exact(geopos, state_abbrev, ring_index)
+                if wn != 0:
                     return state_abbrev
 
+        return NO_STATE
 
 
 
-###############################################################################
-###############################################################################
-###############################################################################
-
 
+    #
+    # Returns True if the geoposition is inside the rectangle (N, E, S, W) of a state.
+    # A rectangle with W > E crosses the antimeridian, see state_borders_format.py.
+    #
+    def in_rectangle(self, rectangle, lat, long):
 
+        if lat > rectangle['N'] or lat < rectangle['S']:
+            return False
+        if rectangle['W'] <= rectangle['E']:
+            return rectangle['W'] <= long <= rectangle['E']
+        return long >= rectangle['W'] or long <= rectangle['E']
 
 
 
 
+    #
+    # The longitude ranges (W, E) of a rectangle: one, or two for a rectangle across the antimeridian
+    #
+    def rectangle_spans(self, rectangle):
 
-###############################################################################
-## Now some methods for testing
-###############################################################################
+        if rectangle['W'] <= rectangle['E']:
+            return [(rectangle['W'], rectangle['E'])]
+        return [(rectangle['W'], 180.0), (-180.0, rectangle['E'])]
 
 
-# Query the state for a single (or a handful of) geopositions
-def single_test():
 
-    tester = state_determination("states-US-pickle2.dat")
 
-    #p_Allentown = Geopoint(40.592930, -75.609839)
+    #
+    # Result cache
+    #
+    # The cache (enabled with cache_size > 0) holds up to cache_size entries of two kinds:
+    #     (lat, long)                 - the result for exactly this geoposition
+    #     (precision, row, col)       - the state of a whole geohash cell (cache_precision
+    #                                   characters, i.e. about 150 m for 7 characters)
+    # A cell is only cached if no polygon edge comes near it, i.e. the cell is provably
+    # entirely inside one state. Entries are evicted in LRU or FIFO order (cache_policy).
+    #
+    # Cells answered directly by the grid index do not go through the cache.
+    #
+    def _cached_state(self, geopos, candidates):
+
+        key = (geopos.lat, geopos.long)
+        if key in self._cache:
+            self._cache_hits += 1
+            return self._cache_get(key)
+
+        cell = self._cache_cell(geopos.lat, geopos.long)
+        if cell is not None and cell in self._cache:
+            self._cache_cell_hits += 1
+            return self._cache_get(cell)
+
+        self._cache_misses += 1
+        state = self._state_of_candidates(geopos, candidates)
+
+        self._cache_put(key, state)
+        if state is not None and cell is not None and self._box_is_clear(*self._cache_cell_box(cell)):
+            self._cache_put(cell, state)
+
+        return state
+
+
+
+
+    def _cache_get(self, key):
+
+        if self._cache_lru:                 # move to the end, i.e. most recently used
+            self._cache[key] = self._cache.pop(key)
+        return self._cache[key]
+
+
+
+
+    def _cache_put(self, key, state):
+
+        self._cache[key] = state
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)         # least recently used / first in
+
+
+
+
+    #
+    # The geohash cell (precision, row, col) of a geoposition, None for NaN or infinite coordinates
+    #
+    def _cache_cell(self, lat, long):
+
+        try:
+            return (self._cache_lat_bits,
+                    int(math.floor((lat + 90.0) / 180.0 * (1 << self._cache_lat_bits))),
+                    int(math.floor((long + 180.0) / 360.0 * (1 << self._cache_long_bits))))
+        except (ValueError, OverflowError):
+            return None
+
+
+
+
+    #
+    # The box (S, N, W, E) of a geohash cell, slightly enlarged to be on the safe side
+    #
+    def _cache_cell_box(self, cell):
+
+        _, row, col = cell
+        height = 180.0 / (1 << self._cache_lat_bits)
+        width = 360.0 / (1 << self._cache_long_bits)
+        margin = 1e-6 * min(height, width)
+        return (-90.0 + row * height - margin, -90.0 + (row + 1) * height + margin,
+                -180.0 + col * width - margin, -180.0 + (col + 1) * width + margin)
+
+
+
+
+    #
+    # Returns True if no polygon edge of any state comes into the box (S, N, W, E).
+    # Then all points of the box have the same winding numbers for all polygons,
+    # i.e. the box is entirely inside one state or entirely outside of all states.
+    # (Conservative: edges are only compared by their bounding boxes.)
+    #
+    # With the grid index only the rings of the border cells which the box overlaps are
+    # compared, since no edge runs through any other cell.
+    #
+    def _box_is_clear(self, south, north, west, east):
+
+        if self._grid is None:
+            rings = [(state_abbrev, ring_index) for state_abbrev, state_data in self.states.items()
+                     for ring_index in range(len(state_data['ring_info']) // 5)]
+        else:
+            if self._border_rings is None:
+                self._build_border_rings()
+            rings = []
+            row_lo, col_lo = self._grid_cell(south, west)
+            row_hi, col_hi = self._grid_cell(north, east)
+            for row in range(row_lo, row_hi + 1):
+                for col in range(col_lo, col_hi + 1):
+                    rings.extend(self._border_rings.get((row, col), ()))
+
+        for state_abbrev, ring_index in rings:
+            state_data = self.states[state_abbrev]
+            info = state_data['ring_info']
+            if (south > info[5 * ring_index + 1] or north < info[5 * ring_index]
+                    or west > info[5 * ring_index + 3] or east < info[5 * ring_index + 2]):
+                continue
+
+            lats, longs = state_data['lats'], state_data['longs']
+            ring_south, ring_north, height, bands = self._ring_slabs(state_abbrev, ring_index)
+
+            for band in range(self._slab_band(south, ring_south, height, len(bands)),
+                              self._slab_band(north, ring_south, height, len(bands)) + 1):
+                for j in bands[band]:
+                    if ((longs[j] >= west or longs[j+1] >= west) and (longs[j] <= east or longs[j+1] <= east)
+                            and (lats[j] >= south or lats[j+1] >= south) and (lats[j] <= north or lats[j+1] <= north)):
+                        return False
+
+        return True
+
+
+
+
+    #
+    # The rings of the border cells of the grid index, for _box_is_clear(): self._border_rings
+    # maps (row, col) of a border cell to the rings (state abbreviation, ring index) whose
+    # bounding box overlaps the cell. Built on the first geohash cell which is checked.
+    #
+    def _build_border_rings(self):
+
+        self._border_rings = dict()
+        for state_abbrev, state_data in self.states.items():
+            info = state_data['ring_info']
+            for ring_index in range(len(info) // 5):
+                row_lo, col_lo = self._grid_cell(info[5 * ring_index], info[5 * ring_index + 2])
+                row_hi, col_hi = self._grid_cell(info[5 * ring_index + 1], info[5 * ring_index + 3])
+
+                for row in range(row_lo, row_hi + 1):
+                    for col in range(col_lo, col_hi + 1):
+                        if isinstance(self._grid.get((row, col)), tuple):
+                            self._border_rings.setdefault((row, col), []).append((state_abbrev, ring_index))
+
+
+
+
+    #
+    # Statistics of the result cache: hits for exact geopositions, hits for cells, misses
+    #
+    def cache_info(self):
+
+        return {'hits': self._cache_hits, 'cell_hits': self._cache_cell_hits, 'misses': self._cache_misses,
+                'size': len(self._cache) if self._cache is not None else 0, 'capacity': self._cache_size}
+
+
+
+
+    def cache_clear(self):
+
+        if self._cache is not None:
+            self._cache.clear()
+        self._cache_hits = self._cache_cell_hits = self._cache_misses = 0
+
+
+
+
+    #
+    # Statistics
+    #
+    # enable_stats() replaces state_of_geoposition, in_rectangle, _is_uncovered and the
+    # winding number tests of this instance by versions which count what they do (instance
+    # attributes, which hide the methods of the class). So as long as the statistics are not
+    # enabled, the queries run exactly the same code as without statistics.
+    #
+    # For each query the statistics are
+    #     bbox_rejects    - states rejected by the bounding box test
+    #     rings_tested    - polygons (rings) with a winding number test
+    #     edges_visited   - edges looked at by the winding number tests (the edges of the slabs)
+    #     wn_seconds      - time of the winding number tests
+    #     seconds         - time of the whole query
+    #     index           - what answered the query without any polygon test: 'raster', 'grid',
+    #                       'coverage', 'cache' or 'cache_cell', None if polygons were tested
+    # callback(query) is called after each query with these and lat, long and state.
+    # The batch method state_of_geopositions is not instrumented.
+    #
+    def enable_stats(self, callback=None):
+
+        self.disable_stats()
+        self._stats = {'queries': 0, 'bbox_rejects': 0, 'rings_tested': 0, 'edges_visited': 0,
+                       'wn_seconds': 0.0, 'seconds': 0.0, 'max_seconds': 0.0, 'index': dict()}
+        query = dict()
+
+        state_of_geoposition = self.state_of_geoposition
+        in_rectangle = self.in_rectangle
+        is_uncovered = self._is_uncovered
+        wn_point_slabs = self.wn_point_slabs
+        wn_point_arcs = self.wn_point_arcs
+        wn_point_simplified = self.wn_point_simplified
+
+        def counted_state_of_geoposition(lat, long):
+            query.update(lat=lat, long=long, bbox_rejects=0, rings_tested=0, edges_visited=0,
+                         wn_seconds=0.0, index=None, in_wn=False)
+            hits = (self._raster_hits, self._cache_hits, self._cache_cell_hits)
+
+            start = clock()
+            state = state_of_geoposition(lat, long)
+            seconds = clock() - start
+
+            if self._raster_hits > hits[0]:
+                query['index'] = 'raster'
+            elif self._cache_hits > hits[1]:
+                query['index'] = 'cache'
+            elif self._cache_cell_hits > hits[2]:
+                query['index'] = 'cache_cell'
+            elif query['index'] is None and query['rings_tested'] == 0 and 'states_tested' not in query:
+                query['index'] = 'grid'
+            query.pop('states_tested', None)
+            del query['in_wn']
+            query.update(state=state, seconds=seconds)
+
+            stats = self._stats
+            stats['queries'] += 1
+            for name in ('bbox_rejects', 'rings_tested', 'edges_visited', 'wn_seconds', 'seconds'):
+                stats[name] += query[name]
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['index'][query['index']] = stats['index'].get(query['index'], 0) + 1
+            if callback is not None:
+                callback(dict(query))
+            return state
+
+        def counted_in_rectangle(rectangle, lat, long):
+            query['states_tested'] = True
+            inside = in_rectangle(rectangle, lat, long)
+            if not inside:
+                query['bbox_rejects'] += 1
+            return inside
+
+        def counted_is_uncovered(lat, long, row_col):
+            uncovered = is_uncovered(lat, long, row_col)
+            if uncovered:
+                query['index'] = 'coverage'
+            return uncovered
+
+        def counted_wn_point_slabs(geop, table, slabs, wn_function=wn_point_slabs):
+            south, north, height, bands = slabs
+            if south <= geop[0] <= north:
+                query['edges_visited'] += len(bands[self._slab_band(geop[0], south, height, len(bands))])
+            if query['in_wn']:              # (the exact test of wn_point_simplified)
+                return wn_function(geop, table, slabs)
+            return timed_wn(wn_function, geop, table, slabs)
+
+        def counted_wn_point_arcs(geop, table, slabs):
+            return counted_wn_point_slabs(geop, table, slabs, wn_point_arcs)
+
+        def counted_wn_point_simplified(geop, state_abbrev, ring_index):
+            south, north, height, bands = self._ring_slabs(state_abbrev, ring_index, True)
+            band = self._tolerance_band(self.states[state_abbrev]['simplified'])
+            if south - band <= geop[0] <= north + band:
+                query['edges_visited'] += len(bands[self._slab_band(geop[0], south, height, len(bands))])
+            return timed_wn(wn_point_simplified, geop, state_abbrev, ring_index)
+
+        def timed_wn(wn_function, *args):
+            query['rings_tested'] += 1
+            query['in_wn'] = True
+            start = clock()
+            try:
+                return wn_function(*args)
+            finally:
+                query['wn_seconds'] += clock() - start
+                query['in_wn'] = False
+
+        self.state_of_geoposition = counted_state_of_geoposition
+        self.in_rectangle = counted_in_rectangle
+        self._is_uncovered = counted_is_uncovered
+        self.wn_point_slabs = counted_wn_point_slabs
+        self.wn_point_arcs = counted_wn_point_arcs
+        self.wn_point_simplified = counted_wn_point_simplified
+
+
+
+
+    #
+    # Removes the counting versions again (the statistics so far are kept)
+    #
+    def disable_stats(self):
+
+        for name in ('state_of_geoposition', 'in_rectangle', '_is_uncovered', 'wn_point_slabs', 'wn_point_arcs',
+                     'wn_point_simplified'):
+            self.__dict__.pop(name, None)
+
+
+
+
+    #
+    # Totals of the statistics since enable_stats(), None if they were never enabled.
+    # index counts the queries by what answered them (None: polygon tests).
+    #
+    def stats_info(self):
+
+        if self._stats is None:
+            return None
+        stats = dict(self._stats, index=dict(self._stats['index']))
+        stats['mean_seconds'] = stats['seconds'] / stats['queries'] if stats['queries'] else 0.0
+        return stats
+
+
+
+
+    #
+    # Builds the grid index now, instead of on the first query
+    # (e.g. before forking worker processes, so that they inherit it).
+    #
+    def build_index(self):
+
+        if self._grid is None and self._grid_size is not None:
+            self._build_grid_index(self._grid_size)
+            if self._coverage_subdivision:
+                self._build_coverage_mask(self._coverage_subdivision)
+
+
+
+
+    #
+    # Grid index
+    #
+    # The area covered by the bounding boxes of all states is divided into square cells.
+    # Each cell is marked as a border cell if any polygon edge (of any state) may run
+    # through it. All other cells are entirely inside one state or entirely outside of
+    # all states, so they can be answered without any polygon test.
+    #
+    # self._grid maps (row, col) of a cell to
+    #     state abbreviation      - cell is entirely inside that state
+    #     tuple of abbreviations  - border cell, the states whose bounding box overlaps
+    #                               the cell (same order as self.states)
+    # Cells which are not in the dict are entirely outside of all states.
+    #
+    def _build_grid_index(self, cell_size):
+
+        border, runs = self.classify_grid(cell_size)
+
+        layout = self.grid_layout(cell_size)
+        self._grid_size, self._grid_lat0, self._grid_long0 = cell_size, layout['lat0'], layout['long0']
+
+        self._grid = dict()
+        for row, row_runs in runs.items():
+            for first, stop, state_abbrev in row_runs:
+                for col in range(first, stop):
+                    self._grid[(row, col)] = state_abbrev
+
+        # Border cells: remember the states whose bounding box overlaps the cell
+        for state_abbrev, state_data in self.states.items():
+            rectangle = state_data['rectangle']
+            for west, east in self.rectangle_spans(rectangle):
+                row_lo, col_lo = self._grid_cell(rectangle['S'], west)
+                row_hi, col_hi = self._grid_cell(rectangle['N'], east)
+
+                for row in range(row_lo, row_hi + 1):
+                    for col in range(col_lo, col_hi + 1):
+                        if (row, col) in border and state_abbrev not in self._grid.get((row, col), ()):
+                            self._grid[(row, col)] = self._grid.get((row, col), ()) + (state_abbrev,)
+
+
+
+
+    #
+    # The layout of the grid of cell_size degrees used by classify_grid and the grid index:
+    # the origin is the southwest corner of the bounding boxes of all rings, and the grid
+    # has enough rows and cols to cover their northeast corner as well.
+    # Cell (row, col) covers lat0 + row * cell_size to lat0 + (row + 1) * cell_size, and the
+    # same for the longitudes from long0.
+    #
+    #     Return: layout  - { 'lat0': lat, 'long0': long, 'cell_size': degrees, 'rows': count, 'cols': count }
+    #
+    def grid_layout(self, cell_size):
+
+        infos = [state_data['ring_info'] for state_data in self.states.values()]
+        lat0 = min(min(info[0::5] or [90.0]) for info in infos)
+        long0 = min(min(info[2::5] or [180.0]) for info in infos)
+        north = max(max(info[1::5] or [-90.0]) for info in infos)
+        east = max(max(info[3::5] or [-180.0]) for info in infos)
+
+        return {'lat0': lat0, 'long0': long0, 'cell_size': cell_size,
+                'rows': int(math.floor((north - lat0) / cell_size)) + 1,
+                'cols': int(math.floor((east - long0) / cell_size)) + 1}
+
+
+
+
+    #
+    # Classifies the cells of a grid of cell_size degrees (see grid_layout) into border
+    # cells, cells entirely inside one state and cells entirely outside of all states.
+    # Does not change the grid index of the tester, so any cell_size can be classified.
+    #
+    #     Return: border  - set of (row, col) of the border cells
+    #             runs    - dict row -> [ (first col, last col + 1, state abbreviation), ... ]:
+    #                       the cells inside a state, as runs of cells, from east to west
+    #                       (cells which are neither in border nor in runs are outside)
+    #
+    def classify_grid(self, cell_size):
+
+        layout = self.grid_layout(cell_size)
+        long0 = layout['long0']
+
+        border, crossings = self._trace_edges(layout)
+        order = dict((state_abbrev, i) for i, state_abbrev in enumerate(self.states))
+
+        border_cols = dict()
+        for row, col in border:
+            border_cols.setdefault(row, []).append(col)
+
+        # Sweep each row from east to west. The winding number of a cell center is the sum
+        # of the crossings east of it (the crossings of the ray to the east). Cells without
+        # border are at least margin away from every edge, so comparing the center with the
+        # crossing longitudes is exact here. Between two crossings (and border cells) all
+        # cells are in the same state, so the sweep jumps from one to the next.
+        runs = dict()
+        for row, row_crossings in crossings.items():
+            row_crossings.sort(key=lambda crossing: crossing[0], reverse=True)
+            cols = sorted(border_cols.get(row, ()), reverse=True)
+
+            wn = dict()             # ring key -> winding number
+            inside = dict()         # state -> number of its rings with wn != 0
+            next_crossing = next_border = 0
+            row_runs = []
+
+            col = int(math.floor((row_crossings[0][0] - long0) / cell_size))
+            while col >= 0:
+                center_long = long0 + (col + 0.5) * cell_size
+
+                while next_crossing < len(row_crossings) and row_crossings[next_crossing][0] > center_long:
+                    _, direction, key = row_crossings[next_crossing]
+                    before = wn.get(key, 0)
+                    wn[key] = before + direction
+                    if before == 0:
+                        inside[key[0]] = inside.get(key[0], 0) + 1
+                    elif wn[key] == 0:
+                        inside[key[0]] -= 1
+                        if inside[key[0]] == 0:
+                            del inside[key[0]]
+                    next_crossing += 1
+
+                while next_border < len(cols) and cols[next_border] > col:
+                    next_border += 1
+                if next_border < len(cols) and cols[next_border] == col:
+                    col -= 1
+                    continue
+
+                # The next column where something changes: the next border cell,
+                # or the first cell whose center is west of the next crossing
+                stop = cols[next_border] if next_border < len(cols) else -1
+                if next_crossing < len(row_crossings):
+                    long = row_crossings[next_crossing][0]
+                    crossing_col = min(col - 1, int(math.floor((long - long0) / cell_size - 0.5)))
+                    while crossing_col >= 0 and long0 + (crossing_col + 0.5) * cell_size >= long:
+                        crossing_col -= 1
+                    stop = max(stop, crossing_col)
+                else:
+                    stop = max(stop, -1)
+
+                if inside:
+                    state_abbrev = min(inside, key=order.get)      # first state wins
+                    if row_runs and row_runs[-1][0] == col + 1 and row_runs[-1][2] == state_abbrev:
+                        row_runs[-1] = (stop + 1, row_runs[-1][1], state_abbrev)
+                    else:
+                        row_runs.append((stop + 1, col + 1, state_abbrev))
+
+                col = stop
+
+            if row_runs:
+                runs[row] = row_runs
+
+        return border, runs
+
+
+
+
+    #
+    # Traces all polygon edges through a grid
+    #
+    #     Input:  layout     - { 'lat0': lat, 'long0': long, 'cell_size': degrees, ... }, see grid_layout
+    #     Return: touched    - set of (row, col) of all cells an edge runs through (or
+    #                          comes closer than a tiny margin to, so that rounding never
+    #                          puts a point into a wrong cell)
+    #             crossings  - dict row -> [ (long, +1|-1, ring key), ... ]: where the edges cross
+    #                          the horizontal line through the cell centers of the row, with the
+    #                          same half-open rule as in wn_point_polygon
+    #
+    def _trace_edges(self, layout):
+
+        cell_size = layout['cell_size']
+        margin = 1e-9 * cell_size
+        lat0, long0 = layout['lat0'], layout['long0']
+
+        touched = set()
+        crossings = dict()
+
+        for state_abbrev, state_data in self.states.items():
+            for ring_index in range(len(state_data['ring_info']) // 5):
+                key = (state_abbrev, ring_index)
+
+                for lats, longs, start, stop, backward in self._ring_pieces(state_abbrev, ring_index):
+                    for j in range(start, stop - 1):
+                        start_lat, start_long = lats[j], longs[j]
+                        end_lat, end_long = lats[j+1], longs[j+1]
+                        if backward:
+                            start_lat, start_long, end_lat, end_long = end_lat, end_long, start_lat, start_long
+
+                        for row, first_col, last_col in self._edge_cells(start_lat, start_long, end_lat, end_long,
+                                                                         lat0, long0, cell_size, margin):
+                            for col in range(first_col, last_col + 1):
+                                touched.add((row, col))
+
+                            center_lat = lat0 + (row + 0.5) * cell_size
+                            if start_lat <= center_lat < end_lat:
+                                direction = 1                               # upward crossing
+                            elif end_lat <= center_lat < start_lat:
+                                direction = -1                              # downward crossing
+                            else:
+                                continue
+
+                            long = start_long + ((center_lat - start_lat) * (end_long - start_long)
+                                                 / (end_lat - start_lat))
+                            crossings.setdefault(row, []).append((long, direction, key))
+
+        return touched, crossings
+
+
+
+
+    #
+    # The cells of a grid (origin lat0, long0, cells of cell_size degrees) which an edge runs
+    # through or comes closer than margin to: yields (row, first col, last col) for each row
+    #
+    def _edge_cells(self, start_lat, start_long, end_lat, end_long, lat0, long0, cell_size, margin):
+
+        lat_lo, lat_hi = min(start_lat, end_lat) - margin, max(start_lat, end_lat) + margin
+
+        for row in range(int(math.floor((lat_lo - lat0) / cell_size)),
+                         int(math.floor((lat_hi - lat0) / cell_size)) + 1):
+
+            # The part of the edge within this row
+            south, north = max(lat_lo, lat0 + row * cell_size), min(lat_hi, lat0 + (row + 1) * cell_size)
+            if start_lat == end_lat:
+                west, east = min(start_long, end_long), max(start_long, end_long)
+            else:
+                t0 = min(1.0, max(0.0, (south - start_lat) / (end_lat - start_lat)))
+                t1 = min(1.0, max(0.0, (north - start_lat) / (end_lat - start_lat)))
+                west = start_long + min(t0, t1) * (end_long - start_long)
+                east = start_long + max(t0, t1) * (end_long - start_long)
+                west, east = min(west, east), max(west, east)
+
+            yield (row, int(math.floor((west - margin - long0) / cell_size)),
+                   int(math.floor((east + margin - long0) / cell_size)))
+
+
+
+
+    #
+    # Coverage mask
+    #
+    # Geopositions outside of all states which fall into a border cell (coast, Canadian and
+    # Mexican border) would still need the polygon tests of all candidate states. So each
+    # border cell is divided again into subdivision x subdivision sub-cells, and a bit mask
+    # per border cell marks the sub-cells which are entirely outside of all states: no
+    # polygon edge runs through the sub-cell, and its center is outside of all polygons.
+    #
+    # self._coverage maps (row, col) of a border cell to the bit mask, bit
+    # (sub_row * subdivision + sub_col) for each sub-cell outside of all states.
+    # Cells without any such sub-cell are not in the dict.
+    #
+    def _build_coverage_mask(self, subdivision):
+
+        size = self._grid_size / subdivision
+        long0 = self._grid_long0
+
+        # The sub-cells which an edge runs through, and the crossings of the sub-cell rows
+        touched, crossings = self._trace_edges({'lat0': self._grid_lat0, 'long0': long0, 'cell_size': size})
+
+        # The border cells of each grid row, from east to west
+        border_cols = dict()
+        for (row, col), cell in self._grid.items():
+            if isinstance(cell, tuple):
+                border_cols.setdefault(row, []).append(col)
+
+        self._coverage = dict()
+
+        for grid_row, cols in border_cols.items():
+            cols.sort(reverse=True)
+
+            for sub_row in range(subdivision):
+                row = grid_row * subdivision + sub_row
+                row_crossings = sorted(crossings.get(row, ()), key=lambda crossing: crossing[0], reverse=True)
+
+                # Sweep from east to west, like in classify_grid. Only the number of rings
+                # with a winding number != 0 is needed: the sub-cell is outside if it is 0.
+                wn = dict()
+                nonzero = 0
+                next_crossing = 0
+
+                for grid_col in cols:
+                    for sub_col in reversed(range(subdivision)):
+                        col = grid_col * subdivision + sub_col
+                        center_long = long0 + (col + 0.5) * size
+
+                        while next_crossing < len(row_crossings) and row_crossings[next_crossing][0] > center_long:
+                            _, direction, key = row_crossings[next_crossing]
+                            before = wn.get(key, 0)
+                            wn[key] = before + direction
+                            nonzero += (wn[key] != 0) - (before != 0)
+                            next_crossing += 1
+
+                        if nonzero == 0 and (row, col) not in touched:
+                            self._coverage[(grid_row, grid_col)] = (self._coverage.get((grid_row, grid_col), 0)
+                                                                    | 1 << (sub_row * subdivision + sub_col))
+
+
+
+
+    #
+    # Returns True if the geoposition is in a sub-cell of its border cell which is
+    # entirely outside of all states, see _build_coverage_mask()
+    #
+    def _is_uncovered(self, lat, long, row_col):
+
+        mask = self._coverage.get(row_col)
+        if not mask:
+            return False
+
+        subdivision = self._coverage_subdivision
+        size = self._grid_size / subdivision
+        sub_row = int(math.floor((lat - self._grid_lat0) / size)) - row_col[0] * subdivision
+        sub_col = int(math.floor((long - self._grid_long0) / size)) - row_col[1] * subdivision
+        if not (0 <= sub_row < subdivision and 0 <= sub_col < subdivision):
+            return False            # (rounding at the cell border)
+        return (mask >> (sub_row * subdivision + sub_col)) & 1 == 1
+
+
+
+
+    #
+    # Returns the value of the raster cell that contains the geoposition: 0 for outside of
+    # all states, RASTER_BORDER for a border cell, otherwise the position of the state in the
+    # state list of the raster + 1 (see state_borders_format.py)
+    #
+    def _raster_value(self, lat, long):
+
+        raster = self._raster
+        try:
+            row = int(math.floor((lat - raster['lat0']) / raster['cell_size']))
+            col = int(math.floor((long - raster['long0']) / raster['cell_size']))
+        except (ValueError, OverflowError):
+            return 0                # NaN or infinite coordinates
+        if not (0 <= row < raster['rows'] and 0 <= col < raster['cols']):
+            return 0
+
+        # The last run of the row which starts at or before col
+        row_offsets = raster['row_offsets']
+        return raster['run_values'][bisect_right(raster['run_starts'], col, row_offsets[row], row_offsets[row + 1]) - 1]
+
+
+
+
+    #
+    # Statistics of the raster: queries answered by the raster (hits) and queries in
+    # border cells, which needed the polygon test
+    #
+    def raster_info(self):
+
+        if self._raster is None:
+            return None
+        queries = self._raster_hits + self._raster_border_hits
+        return {'hits': self._raster_hits, 'border': self._raster_border_hits,
+                'hit_ratio': self._raster_hits / queries if queries else 0.0,
+                'cell_size': self._raster['cell_size'], 'cells': self._raster['rows'] * self._raster['cols'],
+                'runs': len(self._raster['run_starts']), 'bytes': self._raster['bytes']}
+
+
+
+
+    #
+    # Returns the (row, col) of the grid cell that contains the geoposition,
+    # or None if there is no such cell (NaN or infinite coordinates).
+    #
+    def _grid_cell(self, lat, long):
+
+        try:
+            return (int(math.floor((lat - self._grid_lat0) / self._grid_size)),
+                    int(math.floor((long - self._grid_long0) / self._grid_size)))
+        except (ValueError, OverflowError):
+            return None
+
+
+
+
+    #
+    # Winding number (wn) test for many points in a polygon at once
+    # Same rules as wn_point_polygon, but evaluated as NumPy array operations
+    # over blocks of points and edges, i.e. without a Python loop per point.
+    #
+    #     Input:  lats, longs           - NumPy float arrays with the points
+    #             poly_lats, poly_longs - NumPy float arrays with the polygon vertices
+    #     Return: wn                    - NumPy int array with the winding number of each point
+    #
+    def wn_points_polygon(self, lats, longs, poly_lats, poly_longs):
+
+        wn = np.zeros(len(lats), dtype=np.int64)
+
+        # Edge i goes from vertex i-1 to vertex i, like in wn_point_polygon
+        start_lats = np.roll(poly_lats, 1)
+        start_longs = np.roll(poly_longs, 1)
+        delta_lats = poly_lats - start_lats
+        delta_longs = poly_longs - start_longs
+
+        # Keep the temporary (points x edges) arrays at about 1M elements
+        edge_block = 256
+        point_block = max(1, (1 << 20) // edge_block)
+
+        for p in range(0, len(lats), point_block):
+            lat = lats[p:p + point_block, None]
+            long = longs[p:p + point_block, None]
+
+            for e in range(0, len(poly_lats), edge_block):
+                s_lat = start_lats[e:e + edge_block]
+                s_long = start_longs[e:e + edge_block]
+                e_lat = poly_lats[e:e + edge_block]
+
+                # Same expression (and evaluation order) as in is_left
+                left = (delta_longs[e:e + edge_block] * (lat - s_lat)
+                        - (long - s_long) * delta_lats[e:e + edge_block])
+
+                up = (s_lat <= lat) & (e_lat > lat) & (left > 0)        # valid up intersections
+                down = (s_lat > lat) & (e_lat <= lat) & (left < 0)      # valid down intersections
+
+                wn[p:p + point_block] += up.sum(axis=1) - down.sum(axis=1)
+
+        return wn
+
+
+
+
+    #
+    # Tests for many points at once if they are near a polygon
+    # (at most distance away from one of its edges), see wn_point_simplified
+    #
+    #     Input:  lats, longs           - NumPy float arrays with the points
+    #             poly_lats, poly_longs - NumPy float arrays with the polygon vertices
+    #     Return: near                  - NumPy bool array
+    #
+    def near_points_polygon(self, lats, longs, poly_lats, poly_longs, distance):
+
+        near = np.zeros(len(lats), dtype=bool)
+
+        start_lats = np.roll(poly_lats, 1)
+        start_longs = np.roll(poly_longs, 1)
+        delta_lats = poly_lats - start_lats
+        delta_longs = poly_longs - start_longs
+        lengths2 = delta_lats * delta_lats + delta_longs * delta_longs
+        lengths2[lengths2 == 0.0] = np.inf      # edges of length 0: t = 0
+
+        edge_block = 256
+        point_block = max(1, (1 << 20) // edge_block)
+
+        for p in range(0, len(lats), point_block):
+            lat = lats[p:p + point_block, None]
+            long = longs[p:p + point_block, None]
+
+            for e in range(0, len(poly_lats), edge_block):
+                s_lat = start_lats[e:e + edge_block]
+                s_long = start_longs[e:e + edge_block]
+                d_lat = delta_lats[e:e + edge_block]
+                d_long = delta_longs[e:e + edge_block]
+
+                # Same expression as in segment_distance2
+                t = np.clip(((lat - s_lat) * d_lat + (long - s_long) * d_long) / lengths2[e:e + edge_block], 0.0, 1.0)
+                lat_diff = s_lat + t * d_lat - lat
+                long_diff = s_long + t * d_long - long
+                near[p:p + point_block] |= (lat_diff * lat_diff + long_diff * long_diff <= distance * distance).any(axis=1)
+
+        return near
+
+
+
+
+    #
+    # Batch version of state_of_geoposition.
+    # Returns a NumPy object array (same shape as the input) with the abbreviation
+    # of the state where each geoposition is located in, or None.
+    #
+    #     Input:  lats, longs  - array-likes of the same shape
+    #     Return: NumPy array of state abbreviations
+    #
+    def state_of_geopositions(self, lats, longs):
+
+        if np is None:
+            raise ImportError("NumPy is required for state_of_geopositions()")
+
+        lats = np.asarray(lats, dtype=np.float64)
+        longs = np.asarray(longs, dtype=np.float64)
+        if lats.shape != longs.shape:
+            raise ValueError("lats and longs must have the same shape")
+
+        shape = lats.shape
+        lats = lats.ravel()
+        longs = longs.ravel()
+
+        result = np.full(len(lats), NO_STATE, dtype=object)
+        unresolved = np.ones(len(lats), dtype=bool)
+
+        # Raster: only the points in border cells need the polygon tests
+        if self._raster is not None:
+            values = self._np_raster_values(lats, longs)
+            border = values == RASTER_BORDER
+            for value in np.unique(values[~border & (values > 0)]):
+                result[values == value] = self._raster['states'][value - 1]
+            unresolved = border
+            self._raster_hits += int(len(lats) - border.sum())
+            self._raster_border_hits += int(border.sum())
+
+        np_polygons = self._np_polygons()
+
+        # Same order of states as in state_of_geoposition, so that the first
+        # matching state wins in both methods.
+        for state_abbrev, state_data in self.states.items():
+
+            rectangle = state_data['rectangle']
+
+            # Bounding box test for all points which do not have a state yet
+            in_spans = np.zeros(len(lats), dtype=bool)
+            for west, east in self.rectangle_spans(rectangle):
+                in_spans |= (longs >= west) & (longs <= east)
+            remaining = np.flatnonzero(unresolved & in_spans & (lats <= rectangle['N']) & (lats >= rectangle['S']))
+
+            simplified = np_polygons.get((state_abbrev, 'simplified'))
+            info = state_data['ring_info']
+
+            for ring_index in self._ring_order[state_abbrev]:
+                if len(remaining) == 0:
+                    break
+
+                # Only the points in the bounding box of the ring
+                poly_lats, poly_longs = np_polygons[state_abbrev][ring_index]
+                south, north, west, east = info[5 * ring_index:5 * ring_index + 4]
+                in_box = ((lats[remaining] >= south) & (lats[remaining] <= north)
+                          & (longs[remaining] >= west) & (longs[remaining] <= east))
+                candidates = remaining[in_box]
+                if len(candidates) == 0:
+                    continue
+
+                if simplified is None:
+                    wn = self.wn_points_polygon(lats[candidates], longs[candidates], poly_lats, poly_longs)
+                else:
+                    # The simplified ring, and the exact one only for the points near it
+                    simple_lats, simple_longs = simplified[ring_index]
+                    wn = self.wn_points_polygon(lats[candidates], longs[candidates], simple_lats, simple_longs)
+                    near = np.flatnonzero(self.near_points_polygon(lats[candidates], longs[candidates], simple_lats,
+                                                                   simple_longs, self._tolerance_band(state_data['simplified'])))
+                    if len(near) > 0:
+                        wn[near] = self.wn_points_polygon(lats[candidates[near]], longs[candidates[near]],
+                                                          poly_lats, poly_longs)
+
+                inside = candidates[wn != 0]
+                result[inside] = state_abbrev
+                unresolved[inside] = False
+                remaining = remaining[unresolved[remaining]]
+
+        return result.reshape(shape)
+
+
+
+
+    #
+    # Bulk join: same result as state_of_geopositions, for very many geopositions at once.
+    #
+    # The geopositions are sorted by latitude once. Then each edge of each ring is swept over
+    # the geopositions in its latitude range [min_lats, max_lats) - found by binary search in
+    # the sorted latitudes - and adds its contribution (wn_point_polygon rules) to their winding
+    # numbers. So the edges are not tested against all geopositions, only against those which
+    # their latitude range contains: O((N + E) log N + K) for N geopositions and E edges, with
+    # K the number of (geoposition, edge) pairs swept. K is about N times the number of edges
+    # crossing a line of latitude (the border crossings, not all edges), far less than N * E.
+    #
+    # Only the geopositions in the bounding box of a ring and without a state yet are swept,
+    # the pairs are processed in blocks of at most block_pairs (memory).
+    #
+    #     Input:  lats, longs  - array-likes of the same shape
+    #     Return: NumPy array of state abbreviations (None outside of all states)
+    #
+    def state_of_geopositions_sweep(self, lats, longs, block_pairs=1 << 20):
+
+        if np is None:
+            raise ImportError("NumPy is required for state_of_geopositions_sweep()")
+
+        lats = np.asarray(lats, dtype=np.float64)
+        longs = np.asarray(longs, dtype=np.float64)
+        if lats.shape != longs.shape:
+            raise ValueError("lats and longs must have the same shape")
+
+        shape = lats.shape
+        order = np.argsort(lats.ravel(), kind='mergesort')
+        sorted_lats = lats.ravel()[order]
+        sorted_longs = longs.ravel()[order]
+
+        result = np.full(len(sorted_lats), NO_STATE, dtype=object)
+        unresolved = np.ones(len(sorted_lats), dtype=bool)
+
+        # Same order of states as in state_of_geoposition, so that the first
+        # matching state wins in all methods.
+        for state_abbrev, state_data in self.states.items():
+            table = [np.frombuffer(values, dtype=np.float64) for values in self._state_edges(state_abbrev)]
+            edge_lats, edge_longs, delta_lats, delta_longs, min_lats, max_lats = table
+            info, rings = state_data['ring_info'], state_data['rings']
+
+            for ring_index in self._ring_order[state_abbrev]:
+                south, north, west, east = info[5 * ring_index:5 * ring_index + 4]
+
+                # The geopositions in the bounding box of the ring, still sorted by latitude
+                first = np.searchsorted(sorted_lats, south, side='left')
+                stop = np.searchsorted(sorted_lats, north, side='right')
+                window = first + np.flatnonzero(unresolved[first:stop] & (sorted_longs[first:stop] >= west)
+                                                & (sorted_longs[first:stop] <= east))
+                if len(window) == 0:
+                    continue
+                point_lats, point_longs = sorted_lats[window], sorted_longs[window]
+
+                # The geopositions within the latitude range of each edge
+                edges = np.arange(rings[ring_index], rings[ring_index + 1] - 1)
+                edges = edges[delta_lats[edges] != 0.0]             # horizontal edges never count
+                starts = np.searchsorted(point_lats, min_lats[edges], side='left')
+                counts = np.searchsorted(point_lats, max_lats[edges], side='left') - starts
+
+                wn = np.zeros(len(window), dtype=np.int64)
+                ends = np.cumsum(counts)
+                block_first = 0
+                while block_first < len(edges):
+                    # Edges block_first .. block_stop - 1, with at most block_pairs pairs (at least one edge)
+                    block_stop = max(block_first + 1, int(np.searchsorted(ends, ends[block_first] - counts[block_first]
+                                                                             + block_pairs, side='right')))
+                    block_counts = counts[block_first:block_stop]
+                    pair_edges = np.repeat(edges[block_first:block_stop], block_counts)
+                    pair_points = (np.arange(int(block_counts.sum()))
+                                   - np.repeat(np.cumsum(block_counts) - block_counts - starts[block_first:block_stop],
+                                               block_counts))
+
+                    # Same expression and rules as _wn_edges
+                    left = (delta_longs[pair_edges] * (point_lats[pair_points] - edge_lats[pair_edges])
+                            - (point_longs[pair_points] - edge_longs[pair_edges]) * delta_lats[pair_edges])
+                    upward = delta_lats[pair_edges] > 0
+                    wn += np.bincount(pair_points, weights=(upward & (left > 0)).astype(np.int64)
+                                      - (~upward & (left < 0)).astype(np.int64),
+                                      minlength=len(window)).astype(np.int64)
+                    block_first = block_stop
+
+                inside = window[wn != 0]
+                result[inside] = state_abbrev
+                unresolved[inside] = False
+
+        # Back into the order of the input
+        unsorted = np.empty_like(result)
+        unsorted[order] = result
+        return unsorted.reshape(shape)
+
+
+
+
+    #
+    # Batch version of _raster_value. The runs of all rows are searched at once by the key
+    # row * cols + first col of the run, which increases over the whole raster.
+    #
+    def _np_raster_values(self, lats, longs):
+
+        raster = self._raster
+        if self._np_raster is None:
+            rows = np.repeat(np.arange(raster['rows'], dtype=np.int64), np.diff(np.asarray(raster['row_offsets'], dtype=np.int64)))
+            self._np_raster = (rows * raster['cols'] + np.asarray(raster['run_starts'], dtype=np.int64),
+                               np.asarray(raster['run_values'], dtype=np.int64))
+        keys, run_values = self._np_raster
+
+        with np.errstate(invalid='ignore'):
+            rows = np.floor((lats - raster['lat0']) / raster['cell_size'])
+            cols = np.floor((longs - raster['long0']) / raster['cell_size'])
+            valid = (rows >= 0) & (rows < raster['rows']) & (cols >= 0) & (cols < raster['cols'])   # False for NaN
+
+        values = np.zeros(len(lats), dtype=np.int64)
+        cell_keys = rows[valid].astype(np.int64) * raster['cols'] + cols[valid].astype(np.int64)
+        values[valid] = run_values[np.searchsorted(keys, cell_keys, side='right') - 1]
+        return values
+
+
+
+
+    #
+    # The rings of all states as pairs of NumPy arrays (lats, longs), the simplified
+    # rings under the key (state, 'simplified').
+    # These are views on the arrays of the compact storage, nothing is copied.
+    #
+    def _np_polygons(self):
+
+        if self._np_states is None:
+            self._np_states = dict()
+            for state_abbrev, state_data in self.states.items():
+                self._np_states[state_abbrev] = self._np_rings(state_data)
+                if 'simplified' in state_data:
+                    self._np_states[(state_abbrev, 'simplified')] = self._np_rings(state_data['simplified'])
+
+        return self._np_states
+
+
+
+
+    def _np_rings(self, polygons):
+
+        lats = np.frombuffer(polygons['lats'], dtype=np.float64)
+        longs = np.frombuffer(polygons['longs'], dtype=np.float64)
+        rings = polygons['rings']
+        return [(lats[rings[r]:rings[r+1]], longs[rings[r]:rings[r+1]]) for r in range(len(rings) - 1)]
+
+
+
+
+"""
+
+###############################################################################
+# STATE TRACK: Sequential geopositions which are close to each other
+###############################################################################
+
+Returned by state_determination.track(radius). Its state_of_geoposition(lat, long)
+gives the same result as the one of state_determination, but remembers the last
+geoposition that needed a lookup (the anchor), its state and a lower bound of the distance
+from the anchor to the nearest border (border_distance_bound, at most radius degrees).
+
+No border runs through the circle of that distance around the anchor. So all geopositions
+within the circle are in the same state as the anchor (or outside of all states, like the
+anchor) and are answered without any test. Only a geoposition outside of the circle gets
+the full lookup and becomes the new anchor.
+
+For vehicle tracks, where consecutive geopositions are meters apart, almost all geopositions
+are answered from the circle. The radius limits the work of border_distance_bound: the
+larger the radius, the fewer lookups, but the more edges for each bound.
+track_info() returns the number of geopositions answered from the circle (hits) and of lookups.
+
+"""
+class state_track:
+
+
+
+
+    def __init__(self, tester, radius=0.05):
+
+        if not radius > 0:
+            raise ValueError("radius must be > 0")
+        self.tester = tester
+        self.radius = radius
+        self.hits = self.lookups = 0
+        self.reset()
+
+
+
+
+    #
+    # Forgets the anchor, e.g. at the start of a new track
+    #
+    def reset(self):
+
+        self._anchor_lat = self._anchor_long = None
+        self._state = NO_STATE
+        self._distance2 = -1.0          # no geoposition is within the circle
+
+
+
+
+    #
+    # Returns the abbreviation of the state (e.g. PA) where the geoposition
+    # (specified by lat and long) is located in, like state_determination.state_of_geoposition
+    #
+    def state_of_geoposition(self, lat, long):
+
+        if self._distance2 > 0.0:
+            lat_diff, long_diff = lat - self._anchor_lat, long - self._anchor_long
+            if lat_diff * lat_diff + long_diff * long_diff < self._distance2:      # (False for NaN)
+                self.hits += 1
+                return self._state
+
+        self.lookups += 1
+        state = self.tester.state_of_geoposition(lat, long)
+        distance = self.tester.border_distance_bound(lat, long, self.radius)
+
+        # (slightly smaller for the rounding errors of the distances)
+        distance = distance * (1 - 1e-9) - 1e-12
+        self._anchor_lat, self._anchor_long = lat, long
+        self._state = state
+        self._distance2 = distance * distance if distance > 0.0 else -1.0
+        return state
+
+
+
+
+    #
+    # States of a whole track, a list of (lat, long)
+    #
+    def states_of_track(self, geopositions):
+
+        return [self.state_of_geoposition(lat, long) for lat, long in geopositions]
+
+
+
+
+    def track_info(self):
+
+        total = self.hits + self.lookups
+        return {'hits': self.hits, 'lookups': self.lookups, 'hit_ratio': self.hits / total if total else 0.0,
+                'radius': self.radius, 'distance': math.sqrt(self._distance2) if self._distance2 > 0.0 else 0.0}
+
+
+
+
+###############################################################################
+###############################################################################
+###############################################################################
+
+
+
+
+
+
+
+
+###############################################################################
+## Now some methods for testing
+###############################################################################
+
+
+# Query the state for a single (or a handful of) geopositions
+def single_test():
+
+    tester = state_determination("states-US-pickle2.dat")
+
+    #p_Allentown = Geopoint(40.592930, -75.609839)
     #p_Dallas = Geopoint(32.784203, -96.819397)
     #p_Philly = Geopoint(39.9331773,-75.1594191)
     #p_Pittsburg = Geopoint(40.430237, -79.993291)
@@ -190,75 +2175,91 @@ def single_test():
 
 
 
-# Query the state of the 50 US state capitals. Repeat this n times and measure the runtime.
+# The 50 US state capitals as (lat, long), used by fifty_test() and state_benchmark.py
+CAPITALS = [
+    (32.361538,-86.279118),      #Montgomery, Alabama
+    (58.301935,-134.419740),     #Juneau, Alaska
+    (33.448457,-112.073844),     #Phoenix, Arizona
+    (34.736009,-92.331122),      #Little Rock, Arkansas
+    (38.555605,-121.468926),     #Sacramento, California
+    (39.7391667,-104.984167),    #Denver, Colorado
+    (41.767,-72.677),            #Hartford, Connecticut
+    (39.161921,-75.526755),      #Dover, Delaware
+    (30.4518,-84.27277),         #Tallahassee, Florida
+    (33.76,-84.39),              #Atlanta, Georgia
+    (21.30895,-157.826182),      #Honolulu, Hawaii
+    (43.613739,-116.237651),     #Boise, Idaho
+    (39.783250,-89.650373),      #Springfield, Illinois
+    (39.790942,-86.147685),      #Indianapolis, Indiana
+    (41.590939,-93.620866),      #Des Moines, Iowa
+    (39.04,-95.69),              #Topeka, Kansas
+    (38.197274,-84.86311),       #Frankfort, Kentucky
+    (30.45809,-91.140229),       #Baton Rouge, Louisiana
+    (44.323535,-69.765261),      #Augusta, Maine
+    (38.972945,-76.501157),      #Annapolis, Maryland
+    (42.2352,-71.0275),          #Boston, Massachusetts
+    (42.7335,-84.5467),          #Lansing, Michigan
+    (44.95,-93.094),             #Saint Paul, Minnesota
+    (32.320,-90.207),            #Jackson, Mississippi
+    (38.572954,-92.189283),      #Jefferson City, Missouri
+    (46.595805,-112.027031),     #Helana, Montana
+    (40.809868,-96.675345),      #Lincoln, Nebraska
+    (39.160949,-119.753877),     #Carson City, Nevada
+    (43.220093,-71.549127),      #Concord, New Hampshire
+    (40.221741,-74.756138),      #Trenton, New Jersey
+    (35.667231,-105.964575),     #Santa Fe, New Mexico
+    (42.659829,-73.781339),      #Albany, New York
+    (35.771,-78.638),            #Raleigh, North Carolina
+    (48.813343,-100.779004),     #Bismarck, North Dakota
+    (39.962245,-83.000647),      #Columbus, Ohio
+    (35.482309,-97.534994),      #Oklahoma City, Oklahoma
+    (44.931109,-123.029159),     #Salem, Oregon
+    (40.269789,-76.875613),      #Harrisburg, Pennsylvania
+    (41.82355,-71.422132),       #Providence, Rhode Island
+    (34.000,-81.035),            #Columbia, South Carolina
+    (44.367966,-100.336378),     #Pierre, South Dakota
+    (36.165,-86.784),            #Nashville, Tennessee
+    (30.266667,-97.75),          #Austin, Texas
+    (40.7547,-111.892622),       #Salt Lake City, Utah
+    (44.26639,-72.57194),        #Montpelier, Vermont
+    (37.54,-77.46),              #Richmond, Virginia
+    (47.042418,-122.893077),     #Olympia, Washington
+    (38.349497,-81.633294),      #Charleston, West Virginia
+    (43.074722,-89.384444),      #Madison, Wisconsin
+    (41.145548,-104.802042),     #Cheyenne, Wyoming
+]
+
+
+
+
+# Query the state of the 50 US state capitals. Repeat this n times and measure the runtime
+# (with state_benchmark.py: latency percentiles and throughput).
 def fifty_test():
 
-    capitals = []
-    capitals.append((32.361538,-86.279118))       #Montgomery, Alabama
-    capitals.append((58.301935,-134.419740))      #Juneau, Alaska
-    capitals.append((33.448457,-112.073844))      #Phoenix, Arizona
-    capitals.append((34.736009,-92.331122))       #Little Rock, Arkansas
-    capitals.append((38.555605,-121.468926))      #Sacramento, California
-    capitals.append((39.7391667,-104.984167))     #Denver, Colorado
-    capitals.append((41.767,-72.677))             #Hartford, Connecticut
-    capitals.append((39.161921,-75.526755))       #Dover, Delaware
-    capitals.append((30.4518,-84.27277))          #Tallahassee, Florida
-    capitals.append((33.76,-84.39))               #Atlanta, Georgia
-    capitals.append((21.30895,-157.826182))       #Honolulu, Hawaii
-    capitals.append((43.613739,-116.237651))      #Boise, Idaho
-    capitals.append((39.783250,-89.650373))       #Springfield, Illinois
-    capitals.append((39.790942,-86.147685))       #Indianapolis, Indiana
-    capitals.append((41.590939,-93.620866))       #Des Moines, Iowa
-    capitals.append((39.04,-95.69))               #Topeka, Kansas
-    capitals.append((38.197274,-84.86311))        #Frankfort, Kentucky
-    capitals.append((30.45809,-91.140229))        #Baton Rouge, Louisiana
-    capitals.append((44.323535,-69.765261))       #Augusta, Maine
-    capitals.append((38.972945,-76.501157))       #Annapolis, Maryland
-    capitals.append((42.2352,-71.0275))           #Boston, Massachusetts
-    capitals.append((42.7335,-84.5467))           #Lansing, Michigan
-    capitals.append((44.95,-93.094))              #Saint Paul, Minnesota
-    capitals.append((32.320,-90.207))             #Jackson, Mississippi
-    capitals.append((38.572954,-92.189283))       #Jefferson City, Missouri
-    capitals.append((46.595805,-112.027031))      #Helana, Montana
-    capitals.append((40.809868,-96.675345))       #Lincoln, Nebraska
-    capitals.append((39.160949,-119.753877))      #Carson City, Nevada
-    capitals.append((43.220093,-71.549127))       #Concord, New Hampshire
-    capitals.append((40.221741,-74.756138))       #Trenton, New Jersey
-    capitals.append((35.667231,-105.964575))      #Santa Fe, New Mexico
-    capitals.append((42.659829,-73.781339))       #Albany, New York
-    capitals.append((35.771,-78.638))             #Raleigh, North Carolina
-    capitals.append((48.813343,-100.779004))      #Bismarck, North Dakota
-    capitals.append((39.962245,-83.000647))       #Columbus, Ohio
-    capitals.append((35.482309,-97.534994))       #Oklahoma City, Oklahoma
-    capitals.append((44.931109,-123.029159))      #Salem, Oregon
-    capitals.append((40.269789,-76.875613))       #Harrisburg, Pennsylvania
-    capitals.append((41.82355,-71.422132))        #Providence, Rhode Island
-    capitals.append((34.000,-81.035))             #Columbia, South Carolina
-    capitals.append((44.367966,-100.336378))      #Pierre, South Dakota
-    capitals.append((36.165,-86.784))             #Nashville, Tennessee
-    capitals.append((30.266667,-97.75))           #Austin, Texas
-    capitals.append((40.7547,-111.892622))        #Salt Lake City, Utah
-    capitals.append((44.26639,-72.57194))         #Montpelier, Vermont
-    capitals.append((37.54,-77.46))               #Richmond, Virginia
-    capitals.append((47.042418,-122.893077))      #Olympia, Washington
-    capitals.append((38.349497,-81.633294))       #Charleston, West Virginia
-    capitals.append((43.074722,-89.384444))       #Madison, Wisconsin
-    capitals.append((41.145548,-104.802042))      #Cheyenne, Wyoming
-
+    from state_benchmark import run_benchmark
 
-    tester = state_determination("states-US-pickle2.dat")
     n = 20
     print("{0} times 50 state capitals.".format(n))
 
-    start = datetime.now()
-    print("Starting at {0}.".format(start))
+    report = run_benchmark("states-US-pickle2.dat", engines=["grid"], workloads=["capitals"], repeat=n)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+
+
+# Classify a grid of another cell size (like state_raster_generator.py does) and check
+# that the lookups of the tester, which uses its own grid index, do not change.
+def classify_test():
+
+    tester = state_determination("states-US-pickle2.dat", grid_cell_size=0.25)
 
-    for i in range(0,n):
-        for cap in capitals:
-            tester.state_of_geoposition(cap[0], cap[1])
+    before = [tester.state_of_geoposition(lat, long) for lat, long in CAPITALS]
+    border, runs = tester.classify_grid(0.05)
+    after = [tester.state_of_geoposition(lat, long) for lat, long in CAPITALS]
 
-    end = datetime.now()
-    print("Finished at {0}.".format(end))
+    print("{0} border cells, {1} rows with runs".format(len(border), len(runs)))
+    assert before == after, "classify_grid changed the lookups"
+    print("OK: the 50 state capitals are still found in the same states.")
 
 
 
@@ -266,4 +2267,5 @@ def fifty_test():
 
 #single_test()
 #fifty_test()
+#classify_test()
 
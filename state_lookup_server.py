@@ -0,0 +1,425 @@
+"""
+
+HTTP lookup service for the state determination (Python 3, standard library only).
+
+The dataset is loaded once when the server starts. Concurrent requests are merged into
+micro-batches: the geopositions of all requests arriving within --batch-wait seconds
+(or until --batch-size geopositions are queued) are looked up together, in a worker
+thread, so the event loop keeps accepting requests in the meantime.
+
+Usage:
+    python state_lookup_server.py [--data states-US.bin] [--host 127.0.0.1] [--port 8080]
+                                  [--batch-wait 0.002] [--batch-size 1024]
+
+Endpoints:
+
+    GET  /state?lat=40.2&long=-76.9        {"state": "PA"}
+    POST /states                           body {"points": [[40.2, -76.9], [21.3, -157.8], ...]}
+                                           or   {"lats": [...], "longs": [...]}
+                                           ->   {"states": ["PA", "HI", ...]}
+    GET  /metrics                          request and batch counters, queue depth and
+                                           latency percentiles (JSON)
+    GET  /health                           {"status": "ok"}
+
+A geoposition outside of all states gives null.
+
+"""
+
+from __future__ import division, print_function
+
+import argparse
+import asyncio
+import collections
+import json
+import sys
+import time
+
+from state_determination import state_determination
+from urllib.parse import parse_qs, urlsplit
+
+
+
+# Largest accepted request body
+MAX_BODY = 16 * 1024 * 1024
+
+ENDPOINTS = ('/state', '/states', '/metrics', '/health')
+
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+               413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+
+
+class request_error(Exception):
+
+    def __init__(self, status, message):
+
+        Exception.__init__(self, message)
+        self.status = status
+
+
+
+
+#
+# Merges the geopositions of concurrent requests into micro-batches.
+#
+# lookup() queues the geopositions of one request and waits for their states. A single
+# task collects the queue: it starts a batch with the first queued request and waits up
+# to max_wait seconds (or until max_size geopositions are queued) for more, then looks up
+# the whole batch at once in a worker thread.
+#
+class micro_batcher:
+
+    def __init__(self, tester, max_wait=0.002, max_size=1024, metrics=None):
+
+        self.tester = tester
+        self.max_wait = max_wait
+        self.max_size = max_size
+        self.metrics = metrics
+        self.pending = collections.deque()     # (lats, longs, future)
+        self.queued = 0                         # geopositions in pending
+        self.wakeup = None
+        self.task = None
+
+    def start(self):
+
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def lookup(self, lats, longs):
+
+        future = asyncio.get_event_loop().create_future()
+        self.pending.append((lats, longs, future))
+        self.queued += len(lats)
+        if self.metrics is not None:
+            self.metrics.queue_depth(self.queued)
+        self.wakeup.set()
+        return await future
+
+    async def _run(self):
+
+        loop = asyncio.get_event_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            if not self.pending:
+                continue
+
+            # The window: wait for more requests, unless the batch is already full
+            deadline = loop.time() + self.max_wait
+            while self.queued < self.max_size and loop.time() < deadline:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+
+            batch, lats, longs = [], [], []
+            while self.pending and (not batch or len(lats) + len(self.pending[0][0]) <= self.max_size):
+                request_lats, request_longs, future = self.pending.popleft()
+                self.queued -= len(request_lats)
+                batch.append((len(request_lats), future))
+                lats.extend(request_lats)
+                longs.extend(request_longs)
+            if self.pending:
+                self.wakeup.set()           # the rest goes into the next batch
+
+            start = time.time()
+            try:
+                states = await loop.run_in_executor(None, self.lookup_batch, lats, longs)
+            except Exception as error:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            if self.metrics is not None:
+                self.metrics.batch(len(batch), len(lats), time.time() - start)
+
+            offset = 0
+            for count, future in batch:
+                if not future.done():       # (the client may have gone)
+                    future.set_result(states[offset:offset + count])
+                offset += count
+
+    #
+    # The actual lookup of a batch (runs in a worker thread). Each geoposition goes through
+    # the grid index and the coverage mask of state_of_geoposition: most are answered
+    # without any polygon test, which the NumPy batch methods cannot skip.
+    #
+    def lookup_batch(self, lats, longs):
+
+        return [self.tester.state_of_geoposition(lat, long) for lat, long in zip(lats, longs)]
+
+
+
+
+#
+# Counters and latencies of the server, see /metrics
+#
+class server_metrics:
+
+    def __init__(self, window=10000):
+
+        self.start = time.time()
+        self.requests = collections.Counter()       # per endpoint
+        self.errors = 0
+        self.points = 0
+        self.batches = 0
+        self.batch_requests = 0
+        self.batch_points = 0
+        self.max_batch_points = 0
+        self.max_queue_depth = 0
+        self.latencies = collections.deque(maxlen=window)         # of the last requests, seconds
+        self.batch_latencies = collections.deque(maxlen=window)   # of the last batches, seconds
+
+    def request(self, endpoint, points, seconds, error=False):
+
+        self.requests[endpoint if endpoint in ENDPOINTS else 'other'] += 1
+        self.points += points
+        self.errors += error
+        self.latencies.append(seconds)
+
+    def batch(self, requests, points, seconds):
+
+        self.batches += 1
+        self.batch_requests += requests
+        self.batch_points += points
+        self.max_batch_points = max(self.max_batch_points, points)
+        self.batch_latencies.append(seconds)
+
+    def queue_depth(self, depth):
+
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+
+    def report(self, batcher):
+
+        return {
+            'uptime_seconds': round(time.time() - self.start, 3),
+            'requests': dict(self.requests),
+            'errors': self.errors,
+            'points': self.points,
+            'batches': self.batches,
+            'avg_requests_per_batch': round(self.batch_requests / self.batches, 3) if self.batches else None,
+            'avg_points_per_batch': round(self.batch_points / self.batches, 3) if self.batches else None,
+            'max_points_per_batch': self.max_batch_points,
+            'queue_depth': batcher.queued,
+            'max_queue_depth': self.max_queue_depth,
+            'request_latency_ms': _percentiles(self.latencies),
+            'batch_latency_ms': _percentiles(self.batch_latencies),
+        }
+
+
+
+
+def _percentiles(values):
+
+    values = sorted(values)
+    if not values:
+        return None
+    return dict(('p{0}'.format(p), round(values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))] * 1e3, 3))
+                for p in (50, 90, 99, 100))
+
+
+
+
+#
+# Parses the geopositions of a request
+#
+#     Return: lats, longs  - lists of floats
+#
+def parse_query(query):
+
+    params = parse_qs(query)
+    try:
+        return [float(params['lat'][0])], [float(params['long'][0])]
+    except (KeyError, ValueError):
+        raise request_error(400, "lat and long parameters (numbers) are required")
+
+
+def parse_body(body):
+
+    try:
+        data = json.loads(body.decode("utf-8"))
+        if 'points' in data:
+            lats = [float(point[0]) for point in data['points']]
+            longs = [float(point[1]) for point in data['points']]
+        else:
+            lats = [float(lat) for lat in data['lats']]
+            longs = [float(long) for long in data['longs']]
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        raise request_error(400, 'expected JSON {"points": [[lat, long], ...]} or {"lats": [...], "longs": [...]}')
+    if len(lats) != len(longs):
+        raise request_error(400, "lats and longs must have the same length")
+    return lats, longs
+
+
+
+
+#
+# The HTTP server: HTTP/1.1 with keep-alive, just enough for the endpoints above
+#
+class lookup_server:
+
+    def __init__(self, tester, batch_wait=0.002, batch_size=1024):
+
+        self.metrics = server_metrics()
+        self.batcher = micro_batcher(tester, batch_wait, batch_size, self.metrics)
+
+    async def handle_connection(self, reader, writer):
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                start = time.time()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    await self.respond(writer, 400, {'error': "malformed request line"}, False)
+                    break
+
+                try:
+                    length = int(headers.get('content-length', 0) or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self.respond(writer, 400, {'error': "malformed Content-Length"}, False)
+                    break
+                if length > MAX_BODY:
+                    await self.respond(writer, 413, {'error': "request body too large"}, False)
+                    break
+                body = await reader.readexactly(length) if length > 0 else b""
+
+                keep_alive = (headers.get('connection', '').lower() != 'close'
+                              and version.upper() == 'HTTP/1.1')
+                status, result, points = await self.dispatch(method.upper(), target, body)
+                await self.respond(writer, status, result, keep_alive)
+                self.metrics.request(urlsplit(target).path, points, time.time() - start, status != 200)
+                if not keep_alive:
+                    break
+
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, target, body):
+
+        url = urlsplit(target)
+        try:
+            if url.path == '/state':
+                if method != 'GET':
+                    raise request_error(405, "use GET")
+                lats, longs = parse_query(url.query)
+                states = await self.batcher.lookup(lats, longs)
+                return 200, {'state': states[0]}, 1
+
+            if url.path == '/states':
+                if method != 'POST':
+                    raise request_error(405, "use POST")
+                lats, longs = parse_body(body)
+                states = await self.batcher.lookup(lats, longs) if lats else []
+                return 200, {'states': states}, len(lats)
+
+            if url.path == '/metrics':
+                return 200, self.metrics.report(self.batcher), 0
+
+            if url.path == '/health':
+                return 200, {'status': 'ok'}, 0
+
+            raise request_error(404, "unknown path {0}".format(url.path))
+
+        except request_error as error:
+            return error.status, {'error': str(error)}, 0
+        except Exception as error:
+            return 500, {'error': repr(error)}, 0
+
+    async def respond(self, writer, status, result, keep_alive):
+
+        body = json.dumps(result).encode("utf-8")
+        head = ("HTTP/1.1 {0} {1}\r\n"
+                "Content-Type: application/json\r\n"
+                "Content-Length: {2}\r\n"
+                "Connection: {3}\r\n\r\n").format(status, HTTP_STATUS[status], len(body),
+                                                  "keep-alive" if keep_alive else "close")
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def serve(self, host="127.0.0.1", port=8080, ready=None):
+
+        self.batcher.start()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        if ready is not None:
+            ready(server)
+        try:
+            await server.serve_forever()
+        finally:
+            server.close()
+            await self.batcher.stop()
+
+
+
+
+#
+# Loads the dataset (loading messages go to stderr) and builds the grid index
+#
+def load_tester(data_file, grid_cell_size=0.25):
+
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        tester = state_determination(data_file, grid_cell_size)
+        tester.build_index()
+    finally:
+        sys.stdout = stdout
+    return tester
+
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="HTTP lookup service for the state determination.")
+    parser.add_argument("--data", default="states-US.bin", help="states file (default: states-US.bin)")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on (default: 8080)")
+    parser.add_argument("--batch-wait", type=float, default=0.002,
+                        help="seconds to wait for more requests before a batch is looked up (default: 0.002)")
+    parser.add_argument("--batch-size", type=int, default=1024,
+                        help="geopositions at which a batch is looked up right away (default: 1024)")
+    parser.add_argument("--grid-cell-size", type=float, default=0.25, help="grid index cell size in degrees")
+    args = parser.parse_args(argv)
+
+    server = lookup_server(load_tester(args.data, args.grid_cell_size), args.batch_wait, args.batch_size)
+
+    def ready(http_server):
+        print("Listening on http://{0}:{1}/".format(args.host, args.port), file=sys.stderr)
+
+    try:
+        asyncio.run(server.serve(args.host, args.port, ready))
+    except KeyboardInterrupt:
+        pass
+
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+
+Generates the state raster (states-US.raster): all state polygons rasterized into a grid of
+square cells, run-length encoded per row (see state_borders_format.py for the format).
+
+Each cell is entirely outside of all states, entirely inside one state, or a border cell
+which needs the polygon test. The cells are classified like the cells of the grid index of
+state_determination (state_determination.classify_grid), only much finer.
+
+state_determination loads the raster with
+    state_determination("states-US.bin", raster_file="states-US.raster")
+and answers all geopositions in non-border cells with one lookup in the raster;
+raster_info() reports how many queries were answered that way (hit ratio).
+
+Usage:
+    python state_raster_generator.py [states-US.bin] [--output states-US.raster] [--resolution 0.01]
+
+The states file must be the one state_determination loads with the raster.
+
+"""
+
+from __future__ import division, print_function
+
+from array import array
+import argparse
+import os
+import sys
+import time
+
+from state_borders_format import RASTER_BORDER, write_raster
+from state_determination import state_determination
+
+
+
+#
+# Rasterizes the states of a state_determination instance
+#
+#     Input:  tester     - state_determination with the states
+#             cell_size  - size of the cells in degrees
+#     Return: raster     - dict, see state_borders_format.write_raster()
+#
+def build_raster(tester, cell_size):
+
+    border, runs = tester.classify_grid(cell_size)
+    states = list(tester.states)
+    ids = dict((state_abbrev, i + 1) for i, state_abbrev in enumerate(states))
+
+    # The grid covers the bounding boxes of all rings
+    layout = tester.grid_layout(cell_size)
+    rows, cols = layout['rows'], layout['cols']
+
+    border_cols = dict()
+    for row, col in border:
+        border_cols.setdefault(row, []).append(col)
+
+    row_offsets, run_starts, run_values = array('l', [0]), array('I'), array('H')
+
+    for row in range(rows):
+        # All runs of the row from west to east, the border cells as runs as well
+        row_runs = [(first, stop, ids[state_abbrev]) for first, stop, state_abbrev in reversed(runs.get(row, ()))]
+        for col in sorted(border_cols.get(row, ())):
+            if 0 <= col < cols:
+                row_runs.append((col, col + 1, RASTER_BORDER))
+        row_runs.sort()
+
+        # Fill the gaps with runs outside of all states (value 0), merge runs of equal value
+        col, value = 0, 0
+        run_starts.append(0)
+        run_values.append(0)
+        for first, stop, value in row_runs + [(cols, cols, 0)]:
+            if first > col and run_values[-1] != 0:
+                run_starts.append(col)
+                run_values.append(0)
+            if first < stop and run_values[-1] != value:
+                if run_starts[-1] == first:         # replaces an empty run
+                    run_values[-1] = value
+                else:
+                    run_starts.append(first)
+                    run_values.append(value)
+            col = max(col, stop)
+
+        row_offsets.append(len(run_starts))
+
+    return {'lat0': layout['lat0'], 'long0': layout['long0'], 'cell_size': cell_size,
+            'rows': rows, 'cols': cols, 'states': states,
+            'row_offsets': row_offsets, 'run_starts': run_starts, 'run_values': run_values}
+
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description="Generates the run-length encoded state raster.")
+    parser.add_argument("state_file", nargs="?", default="states-US.bin",
+                        help="states file (default: states-US.bin)")
+    parser.add_argument("--output", default="states-US.raster", help="output file (default: states-US.raster)")
+    parser.add_argument("--resolution", type=float, default=0.01,
+                        help="cell size in degrees (default: 0.01)")
+    args = parser.parse_args(argv)
+
+    tester = state_determination(args.state_file, grid_cell_size=None)
+
+    print("Rasterizing with cells of {0} degrees ... ".format(args.resolution), end="")
+    sys.stdout.flush()
+    start = time.time()
+    raster = build_raster(tester, args.resolution)
+    build_seconds = time.time() - start
+    print("Done.")
+
+    write_raster(raster, args.output)
+
+    # Statistics: cells by kind (only the cells of the rows, outside cells included)
+    counts = [0, 0, 0]          # outside, inside a state, border
+    for row in range(raster['rows']):
+        first, stop = raster['row_offsets'][row], raster['row_offsets'][row + 1]
+        for i in range(first, stop):
+            length = (raster['run_starts'][i + 1] if i + 1 < stop else raster['cols']) - raster['run_starts'][i]
+            value = raster['run_values'][i]
+            counts[0 if value == 0 else 2 if value == RASTER_BORDER else 1] += length
+
+    print("Build time:    {0:.2f} s".format(build_seconds))
+    print("Grid:          {0} rows x {1} cols, {2} runs".format(raster['rows'], raster['cols'], len(raster['run_starts'])))
+    print("Cells:         {0} outside, {1} inside a state, {2} border".format(*counts))
+    print("Border share:  {0:.3%} of the cells within states".format(counts[2] / max(counts[1] + counts[2], 1)))
+    print("Artifact size: {0} bytes ({1})".format(os.path.getsize(args.output), args.output))
+
+
+
+if __name__ == "__main__":
+    main()
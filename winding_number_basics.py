@@ -1,5 +1,7 @@
 from __future__ import division, print_function
+from array import array
 from collections import namedtuple
+import operator
 import sys
 
 if sys.version_info.major == 2:
@@ -14,6 +16,7 @@ else:
 # Type definitions, see  below for more details
 Geopoint = namedtuple('Geopoint', ['lat', 'long'])
 Line = namedtuple('Line', ['p1', 'p2'])
+EdgeTable = namedtuple('EdgeTable', ['lats', 'longs', 'delta_lats', 'delta_longs', 'min_lats', 'max_lats'])
 
 
 
@@ -57,6 +60,12 @@ Line      - Python namedtuple of two geopoints, i.e.
 
 Polygon - Python list of Geopoints, i.e. [ Geopoint, Geopoint, Geopoint, ..., Geopoint ]
 
+EdgeTable - Python namedtuple of packed arrays (array('d')) with the edges of a polygon,
+            precomputed once, see edge_table():
+              lats, longs               - the vertices (of the closed polygon)
+              delta_lats, delta_longs   - for edge j (vertex j to vertex j+1): lats[j+1] - lats[j], ...
+              min_lats, max_lats        - the latitude range of edge j
+
 
 """
 
@@ -77,8 +86,41 @@ Polygon - Python list of Geopoints, i.e. [ Geopoint, Geopoint, Geopoint, ..., Ge
 #
 def is_left(geop, line):
 
-    return ( (line.p2.long - line.p1.long) * (geop.lat - line.p1.lat)
-            -  (geop.long - line.p1.long) * (line.p2.lat - line.p1.lat) )
+    (start_lat, start_long), (end_lat, end_long) = line
+    return ( (end_long - start_long) * (geop[0] - start_lat)
+            -  (geop[1] - start_long) * (end_lat - start_lat) )
+
+
+
+#
+# Same as is_left, for edge j of an edge table (the line from vertex j to vertex j+1):
+# the differences of the coordinates are taken from the table instead of being computed.
+#
+def is_left_edge(geop, table, j):
+
+    return ( table.delta_longs[j] * (geop[0] - table.lats[j])
+            -  (geop[1] - table.longs[j]) * table.delta_lats[j] )
+
+
+
+#
+# Precomputes the edge table of a polygon (see above). The polygon is closed by
+# repeating its last vertex in front, so edge j of the table is the edge from
+# polygon[j-1] to polygon[j], the same edges in the same order as in wn_point_polygon.
+#
+#     Input:  polygon  - List of Geopoints (or (lat, long) tuples)
+#     Return: EdgeTable
+#
+def edge_table(polygon):
+
+    lats = array('d', [point[0] for point in polygon[-1:] + polygon[:]])
+    longs = array('d', [point[1] for point in polygon[-1:] + polygon[:]])
+
+    return EdgeTable(lats, longs,
+                     array('d', map(operator.sub, lats[1:], lats[:-1])),
+                     array('d', map(operator.sub, longs[1:], longs[:-1])),
+                     array('d', map(min, lats[1:], lats[:-1])),
+                     array('d', map(max, lats[1:], lats[:-1])))
 
 
 
@@ -88,35 +130,34 @@ def is_left(geop, line):
 #
 #     Input:  geop     - Geopoint(lat, long)
 #             polygon  - List of Geopoints: [ Geopoint(lat, long), Geopoint(lat, long), ..., Geopoint(lat, long) ]
+#                        or its EdgeTable (faster, if the same polygon is tested many times)
 #     Return: wn       - the winding number (=0 if point is outside polygon)
 #
 def wn_point_polygon(geop, polygon):
 
+    if not isinstance(polygon, EdgeTable):
+        polygon = edge_table(list(polygon))
+
+    lats, longs, delta_lats, delta_longs, min_lats, max_lats = polygon
+    lat, long = geop[0], geop[1]
     wn = 0      # winding number counter
 
     # loop through all edges of the polygon
-    for i in range(len(polygon)):
-
-        # Make sure that we have the two points of the edge as Geopoint type
-        if not isinstance(polygon[i-1], Geopoint):
-            start = Geopoint._make(polygon[i-1])
-        else:
-            start = polygon[i-1]
+    for j in range(len(delta_lats)):
 
-        if not isinstance(polygon[i], Geopoint):
-            end = Geopoint._make(polygon[i])
-        else:
-            end = polygon[i]
+        # An edge with start y <= P.y < end y is an upward crossing, one with
+        # end y <= P.y < start y a downward crossing: in both cases P.y is in
+        # the (half-open) latitude range of the edge. All other edges are skipped.
+        if min_lats[j] <= lat < max_lats[j]:
 
+            left = delta_longs[j] * (lat - lats[j]) - (long - longs[j]) * delta_lats[j]     # is_left_edge
 
-        if start.lat <= geop.lat:                               # make sure that start y <= P.y
-            if end.lat > geop.lat:                              # an upward crossing
-                if is_left( geop, Line(start, end) ) > 0:       # P is left of edge
+            if delta_lats[j] > 0:                               # an upward crossing
+                if left > 0:                                    # P is left of edge
                     wn += 1                                     # a valid up intersection
 
-        else:                                                   # start y > P.y (no test needed)
-            if end.lat <= geop.lat:                             # a downward crossing
-                if is_left( geop, Line(start, end) ) < 0:       # P is right of edge
+            else:                                               # a downward crossing
+                if left < 0:                                    # P is right of edge
                     wn -= 1                                     # a valid down intersection
 
 